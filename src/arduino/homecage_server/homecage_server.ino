@@ -2,6 +2,8 @@
     This program is a server for controlling the hardware peripherals attached to the HomeCage system.
     It waits for commands over a serial port (python client in our case) and performs the desired action upon receiving the command.
     There is no proper message passing system and it simply uses various magic byte values as messages.
+    Every command that was carried out is acknowledged with an "ACK <byte>" line (e.g. "ACK 1" once a pellet
+    is presented), which the python client uses to time the commands.
     Note: These bytes can cause different outcomes depending on the state the program is in at the time
     of receiving. The lack of real message passing system means the program is rather fragile. I recommend
     not modifying this program too much. Utility may instead be found by recycling specific functions.
@@ -318,6 +320,7 @@ bool listenForStartCommand() {
     }
     else if (authByte == 'Y' ) {
       digitalWrite(ledPin, HIGH);
+      Serial.write("ACK Y\n");
       return false;
     }
 
@@ -342,10 +345,12 @@ int startSession() {
         
         case ('1'):
           if(displayPellet() == 0){return 0;}
+          Serial.write("ACK 1\n");
           break;
           
         case ('2'):
           if(displayPellet() == 0){return 0;}
+          Serial.write("ACK 2\n");
           break;
           
         case ('3'):
@@ -373,10 +378,12 @@ int startSession() {
           if (isDigit(stepperDist2)){stepperDistInt2 = stepperDist2 - '0';}
           else{stepperDistInt2 = 10 + stepperDist2 - 'a';}
           if (moveStepper_both(stepperDistInt1, stepperDistInt2, servoDistInt) == 0){return 0;} 
+          Serial.write("ACK 3\n");
           break;
         case ('4'):
           if(displayPellet() == 0){
             return 0;}
+          Serial.write("ACK 4\n");
           break;
         default:
           break;
@@ -443,6 +450,7 @@ void loop(){
   }
   else{
     if(listenForStartCommand()){
+    Serial.write("ACK A\n");
     digitalWrite(digitalSwitchPin, HIGH);
     digitalWrite(ledPin, LOW);
     startSession();
@@ -1,23 +1,67 @@
 """
-    Author: Julian Pitney
-    Email: JulianPitney@gmail.com
+    Author: Julian Pitney, Junzheng Wu, Gavin Heidenreich
+    Email: JulianPitney@gmail.com, jwu220@uottawa.ca, gheidenr@uottawa.ca
     Organization: University of Ottawa (Silasi Lab)
+
+    Client side of the protocol spoken by the Arduino server (src/arduino/homecage_server).
+
+    Commands are sent by name (see COMMANDS). The server answers every command it carried out with an
+    "ACK <byte>" line, so each command's round trip (e.g. how long an arm raise really takes) is measured
+    and kept in <latencies>. A reader thread owns the receiving side of the serial port: it matches ACKs
+    to the commands waiting for them, sets <term> when the server reports the end of a session, and passes
+    every line on to the subscribed callbacks.
 """
 
 import serial
-from time import sleep
+import time
+from collections import deque
+from threading import Thread, Lock, Event
+
+# command name -> byte the Arduino server expects
+COMMANDS = {
+    'start_session': b'A',
+    'reject': b'Y',
+    'present_left': b'1',
+    'present_right': b'2',
+    'position': b'3',
+    'present_both': b'4',
+}
+
+
+class Command(object):
+    def __init__(self, name, sent_at):
+        self.name = name
+        self.sent_at = sent_at
+        self.acked_at = None
+        self.ok = None
+        self.done = Event()
+
+    @property
+    def latency(self):
+        if self.acked_at is None:
+            return None
+        return self.acked_at - self.sent_at
+
+    def wait(self, timeout=None):
+        '''
+        :return: True if the server acknowledged the command, False if it didn't (timeout, or the
+                 session ended before the command was carried out)
+        '''
+        self.done.wait(timeout)
+        return bool(self.ok)
+
 
 class client(object):
-    def __init__(self, arduinoSerialPortPath, baudrate):
+    def __init__(self, arduinoSerialPortPath, baudrate, ready_timeout=10.0):
 
         # Open serial connection with periphral board (Note: Arduino will reset
         #   when you open a serial connection with it, so a ~3 second delay
         #   after opening the connection is recommended)
-        self.serialInterface = serial.Serial(arduinoSerialPortPath, baudrate)
-        
+        self.serialInterface = serial.Serial(arduinoSerialPortPath, baudrate, timeout=ready_timeout)
+
         self.serialInterface.flushInput()
-        sleep(3)
-        # Wait for Arduino to say it's ready TODO: readline is blocking....add timeout eventually
+        time.sleep(3)
+        # Wait for Arduino to say it's ready
         readyMsg = self.serialInterface.readline()
         print(".....ok?")
         if readyMsg == b"READY\n":
@@ -26,11 +70,96 @@ class client(object):
             print("Arduino took too long to respond...shutting down")
             exit()
 
+        # commands sent and not acknowledged yet, oldest first, per command byte
+        self.pending = dict((code, deque()) for code in COMMANDS.values())
+        self.pending_lock = Lock()
+        self.write_lock = Lock()
+        # command name -> round trip times in seconds
+        self.latencies = dict((name, []) for name in COMMANDS)
+        self.subscribers = []
+        self.term = Event()
+        self.stopped = False
+        # the reader thread wakes up at least this often to check if it should stop
+        self.serialInterface.timeout = 0.5
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
 
-    # DEPRECATED: This function was used to read RFIDs from the Arduino, before we switched the 
-    # RFID reader from the Arduino to the PC. 
-    def listenForRFID(self):
+    def send(self, name, payload=b''):
+        '''
+        Send command <name> (see COMMANDS) followed by <payload> (e.g. the stepper positions).
+        :return: a Command to wait on for the server's acknowledgement
+        '''
+        code = COMMANDS[name]
+        with self.write_lock:
+            command = Command(name, time.perf_counter())
+            with self.pending_lock:
+                self.pending[code].append(command)
+            self.serialInterface.write(code + payload)
+            self.serialInterface.flush()
+        return command
 
-        RFID = self.serialInterface.readline().rstrip().decode()
-        self.serialInterface.flushInput()
-        return RFID
+    def subscribe(self, callback):
+        '''
+        Have callback(line, time.perf_counter() time) called from the reader thread for every line received.
+        '''
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def run(self):
+        while not self.stopped and self.serialInterface.is_open:
+            try:
+                line = self.serialInterface.readline()
+            except serial.SerialException as e:
+                print("Arduino client: %s" % e)
+                break
+            if not line:
+                continue
+            received_at = time.perf_counter()
+            line = line.rstrip().decode(errors='replace')
+            if line.startswith("ACK "):
+                self.acknowledge(line[4:].encode(), received_at)
+            elif line == "TERM":
+                # anything still waiting was cut short by the mouse leaving
+                self.fail_pending()
+                self.term.set()
+            for callback in list(self.subscribers):
+                callback(line, received_at)
+
+    def acknowledge(self, code, received_at):
+        with self.pending_lock:
+            if not self.pending.get(code):
+                print("Arduino client: unexpected ACK %s" % code)
+                return
+            command = self.pending[code].popleft()
+        command.acked_at = received_at
+        command.ok = True
+        self.latencies[command.name].append(command.latency)
+        command.done.set()
+
+    def fail_pending(self):
+        with self.pending_lock:
+            commands = [command for queue in self.pending.values() for command in queue]
+            for queue in self.pending.values():
+                queue.clear()
+        for command in commands:
+            command.ok = False
+            command.done.set()
+
+    def latency_summary(self):
+        '''
+        :return: dict of command name -> (count, mean, max) round trip time in seconds
+        '''
+        summary = {}
+        for name, latencies in self.latencies.items():
+            if latencies:
+                summary[name] = (len(latencies), sum(latencies) / len(latencies), max(latencies))
+        return summary
+
+    def close(self):
+        self.stopped = True
+        self.thread.join(1.0)
+        self.serialInterface.close()
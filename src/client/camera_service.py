@@ -0,0 +1,223 @@
+"""
+    Resident camera service. It opens the camera once and keeps it open, holding a pre-roll of the
+    most recent frames in memory (see FrameRing in driver_for_a_better_camera.py). main.py talks to it
+    over a local multiprocessing connection (a named pipe on Windows, a unix socket elsewhere) and asks
+    it to cut one video per session out of the stream.
+
+    Requests are (command, kwargs) tuples, replies are dicts with 'ok' set to True or False ('error'
+    explains a failure). Commands:
+        start   path, preroll, show, mode
+                                    open a video at <path> starting with the frames captured in the last
+                                    <preroll> seconds (measured here, so the two processes' clocks don't matter),
+                                    <mode> is one of the retention modes (full, proxy or none, see retention.py)
+        stop                        end the current video, the rest of it is written out in the background
+        wait_closed timeout         wait until the video file is closed, answers with its frames, bytes and duration
+        grab                        latest frame (grayscale) with its sequence number and capture time
+        stats                       frame counters and frame rate
+        health                      whether the camera and the worker threads are alive
+        quit                        close the camera and exit
+
+    The service outlives main.py, so restarting main.py after a crash reconnects to the running
+    service instead of opening the camera again. Start it by hand with
+        python camera_service.py --c 0
+    or let CameraClient launch it.
+"""
+import argparse
+import os
+import platform
+import tempfile
+import time
+from multiprocessing.connection import Client, Listener
+from subprocess import Popen
+
+from driver_for_a_better_camera import WebcamVideoStream, Recoder, CAPTURE_MODES
+from frame_channel import SharedFrameChannel
+
+if platform.system() == 'Windows':
+    CAMERA_SERVICE_ADDRESS = r'\\.\pipe\hasra_camera'
+else:
+    CAMERA_SERVICE_ADDRESS = os.path.join(tempfile.gettempdir(), 'hasra_camera.sock')
+CAMERA_SERVICE_AUTHKEY = b'hasra_camera'
+CAMERA_FPS = 150
+# ring slots a pre-roll never reaches into, room for the camera while the recorder catches up
+RING_SLACK = 64
+
+
+class CameraService(object):
+    '''
+    :param preroll: seconds of video kept from before the trigger of each start command
+    :param start_latency: longest time (seconds) between the trigger and the start command reaching the service
+                          that the ring still covers
+    '''
+    def __init__(self, camera_src=0, preroll=1.0, channel_name='hasra_frames', capture_mode='bgr',
+                 writer_backend='opencv', start_latency=0.5):
+        self.preroll = preroll
+        self.start_latency = start_latency
+        self.start_time = time.time()
+        # room for the pre-roll and the start latency at the camera's frame rate, plus slack for the recorder
+        self.vs = WebcamVideoStream(src=camera_src, capture_mode=capture_mode,
+                                    ring_capacity=int((preroll + start_latency) * CAMERA_FPS) + RING_SLACK,
+                                    ring_slack=RING_SLACK).start()
+        # the channel carries frames of whatever size the camera actually delivers
+        self.channel = SharedFrameChannel(channel_name, shape=self.vs.ring.frames.shape[1:], create=True)
+        self.recorder = Recoder(vs=self.vs, channel=self.channel, writer_backend=writer_backend).start()
+        self.segment_path = None
+        self.running = True
+
+    def start(self, path, preroll=0., show=False, mode='full'):
+        if self.recorder.segment_active:
+            return {'ok': False, 'error': "already recording %s" % self.segment_path}
+        if preroll > self.preroll + self.start_latency:
+            print("[WARN] %.2f s of pre-roll asked for, the ring holds %.2f s" %
+                  (preroll, self.preroll + self.start_latency))
+            preroll = self.preroll + self.start_latency
+        self.recorder.open_segment(path, since=time.time() - preroll, show=show, mode=mode)
+        self.segment_path = path
+        return {'ok': True, 'path': path, 'mode': mode}
+
+    def stop(self):
+        if not self.recorder.segment_active:
+            return {'ok': False, 'error': "not recording"}
+        self.recorder.end_segment()
+        path, self.segment_path = self.segment_path, None
+        return {'ok': True, 'path': path}
+
+    def wait_closed(self, timeout=10.0):
+        summary = self.recorder.wait_closed(timeout)
+        if summary is None:
+            return {'ok': False, 'error': "video not closed after %.1f s" % timeout}
+        reply = {'ok': True}
+        reply.update(summary)
+        return reply
+
+    def grab(self):
+        latest = self.channel.latest(timeout=0)
+        if latest is None:
+            # frames only go through the channel while recording, fall back to the capture ring
+            frame = self.vs.read()
+            if frame is None:
+                return {'ok': False, 'error': "no frame captured yet"}
+            return {'ok': True, 'seq': None, 'timestamp': None, 'frame': frame.copy()}
+        seq, timestamp, frame = latest
+        return {'ok': True, 'seq': seq, 'timestamp': timestamp, 'frame': frame}
+
+    def stats(self):
+        ring = self.vs.ring
+        elapsed = (time.time() - self.start_time)
+        return {'ok': True, 'captured': ring.written, 'dropped': ring.dropped, 'pending': ring.pending(),
+                'fps': ring.written / elapsed if elapsed > 0 else 0., 'uptime': elapsed,
+                'recording': self.segment_path, 'segment_frames': self.recorder.segment_frames}
+
+    def health(self):
+        ring = self.vs.ring
+        last_frame_age = None
+        if ring.written > 0:
+            last_frame_age = time.time() - float(ring.timestamps[(ring.written - 1) % ring.capacity])
+        camera_ok = self.vs.stream.isOpened() and self.vs.thread.is_alive()
+        recorder_ok = self.recorder.thread.is_alive()
+        return {'ok': camera_ok and recorder_ok, 'camera': camera_ok, 'recorder': recorder_ok,
+                'last_frame_age': last_frame_age}
+
+    def quit(self):
+        self.running = False
+        self.vs.stop()
+        self.recorder.stop()
+        return {'ok': True}
+
+    def handle(self, command, kwargs):
+        if command not in ('start', 'stop', 'wait_closed', 'grab', 'stats', 'health', 'quit'):
+            return {'ok': False, 'error': "unknown command %s" % command}
+        try:
+            return getattr(self, command)(**kwargs)
+        except Exception as e:
+            return {'ok': False, 'error': repr(e)}
+
+    def serve(self, address=CAMERA_SERVICE_ADDRESS):
+        if platform.system() != 'Windows' and os.path.exists(address):
+            os.remove(address)
+        listener = Listener(address, authkey=CAMERA_SERVICE_AUTHKEY)
+        print("[INFO] camera service listening on %s" % address)
+        # one client (main.py) at a time, a new one can connect once the old one is gone
+        while self.running:
+            conn = listener.accept()
+            print("[INFO] client connected")
+            while self.running:
+                try:
+                    command, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    print("[INFO] client disconnected")
+                    break
+                conn.send(self.handle(command, kwargs))
+            conn.close()
+        listener.close()
+        self.channel.close()
+
+
+class CameraClient(object):
+    '''
+    main.py's handle on the camera service. Connects to a running service, or launches one
+    (with <launch_args> for camera_service.py) and waits up to <timeout> seconds for it to come up.
+    '''
+    def __init__(self, address=CAMERA_SERVICE_ADDRESS, launch_args=None, timeout=30.0):
+        self.address = address
+        self.process = None
+        self.conn = self.connect()
+        if self.conn is None and launch_args is not None:
+            print("Starting camera service...")
+            self.process = Popen(["python", "camera_service.py"] + list(launch_args))
+            deadline = time.time() + timeout
+            while self.conn is None and time.time() < deadline:
+                time.sleep(0.2)
+                self.conn = self.connect()
+        if self.conn is None:
+            raise IOError("Could not connect to the camera service at %s" % address)
+
+    def connect(self):
+        try:
+            return Client(self.address, authkey=CAMERA_SERVICE_AUTHKEY)
+        except (OSError, EOFError):
+            return None
+
+    def request(self, command, **kwargs):
+        self.conn.send((command, kwargs))
+        reply = self.conn.recv()
+        if not reply['ok'] and 'error' in reply:
+            print("Camera service: %s failed: %s" % (command, reply['error']))
+        return reply
+
+    def start(self, path, preroll=0., show=False, mode='full'):
+        return self.request('start', path=path, preroll=preroll, show=show, mode=mode)
+
+    def stop(self):
+        return self.request('stop')
+
+    def wait_closed(self, timeout=10.0):
+        return self.request('wait_closed', timeout=timeout)
+
+    def grab(self):
+        return self.request('grab')
+
+    def stats(self):
+        return self.request('stats')
+
+    def health(self):
+        return self.request('health')
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--c', help='an integer for the camera index', dest='camera_index', type=int, default=0)
+    parser.add_argument('--s', help='name of the shared frame channel', dest='channel_name', default='hasra_frames')
+    parser.add_argument('--m', help='capture mode: ' + ', '.join(CAPTURE_MODES), dest='capture_mode', default='bgr')
+    parser.add_argument('--w', help='video writer backend (see video_writers.py)', dest='writer_backend', default='opencv')
+    parser.add_argument('--preroll', help='seconds of video kept from before each start command', type=float, default=1.0)
+    parser.add_argument('--start-latency', help='longest delay (seconds) from a trigger to its start command',
+                        dest='start_latency', type=float, default=0.5)
+    args = parser.parse_args()
+
+    service = CameraService(args.camera_index, args.preroll, args.channel_name, args.capture_mode, args.writer_backend,
+                            args.start_latency)
+    service.serve()
@@ -4,6 +4,7 @@
     Organization: University of Ottawa (Silasi Lab)
 """
 
+import numpy as np
 import pandas as pd
 from sklearn.preprocessing import MinMaxScaler
 
@@ -16,18 +17,28 @@ sd: standard deviation over a specified rolling window
 peak_velocity_point: takes the difference between each value as data[n+1] - data[n], gets the mean over a specified rolling window,
     then normalizes the data between -1 and 1. 1 is the point of peak velocity forwards, and -1 is the point of peak velocity moving
     backwards.
+
+If the video was recorded with its frame timestamp sidecar (<video>.ts.npy, written by driver_for_a_better_camera.py),
+pass it as frame_timestamps_path and the differences are divided by the real time between frames instead of assuming
+a constant frame interval.
 '''
 
 
 h5_file_path = '/home/gavin/Documents/python_projects/DLC/stereo_2nd-silasi_lab-2020-07-31-3d/2020-07-29_(15-41-23)_00783A32F484_16_2024_DLC_3D.h5'
+frame_timestamps_path = None
 set_of_metrics = {'peak_velocity_point'}
 list_of_bodyparts = ['index', 'pinky', 'hand']
 
 class h5_to_csv:
-    def __init__(self, h5_file_path, list_of_bodyparts, list_of_metrics, sliding_window_num_frames):
+    def __init__(self, h5_file_path, list_of_bodyparts, list_of_metrics, sliding_window_num_frames, frame_timestamps_path=None):
         self.set_of_metrics = set_of_metrics
         self.df = pd.read_hdf(h5_file_path)
         self.df.dropna(how='all', inplace=True)
+        # capture time (seconds) of every remaining row, looked up by frame number
+        self.frame_times = None
+        if frame_timestamps_path is not None:
+            timestamps = np.load(frame_timestamps_path)['timestamp']
+            self.frame_times = pd.Series(timestamps[self.df.index], index=self.df.index)
         self.sliding_window_num_frames = sliding_window_num_frames
         self.list_of_bodyparts = list_of_bodyparts
 
@@ -47,6 +58,8 @@ class h5_to_csv:
             for bp in self.list_of_bodyparts:
                 for coord in coords:
                     self.df['metrics', bp, coord + '_diff'] = self.df.loc[:, ('DLC_3D', bp, coord)].diff()
+                    if self.frame_times is not None:
+                        self.df['metrics', bp, coord + '_diff'] /= self.frame_times.diff()
                     self.df['metrics', bp, coord + '_diff_ma'] = self.df.loc[:, ('metrics', bp, coord + '_diff')].rolling(self.sliding_window_num_frames, self.sliding_window_num_frames//2).mean()
                     tmp = self.df['metrics', bp, coord + '_diff_ma']
                     self.df['metrics', bp, coord + '_diff_ma_scaled'] = 2 * ((tmp - tmp.min())/ (tmp.max() - tmp.min())) - 1
@@ -64,7 +77,7 @@ class h5_to_csv:
 
         
 
-csvMaker = h5_to_csv(h5_file_path, list_of_bodyparts, set_of_metrics, 15)
+csvMaker = h5_to_csv(h5_file_path, list_of_bodyparts, set_of_metrics, 15, frame_timestamps_path)
 csvMaker.add_metrics()
 csvMaker.print_csv_output()
 
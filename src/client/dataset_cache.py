@@ -0,0 +1,193 @@
+"""
+    Decoded copy of a labelled detector dataset, so training and evaluation don't decode every JPEG again.
+
+    The labelled frames (<data>/0 and <data>/1, written by data_utils.generate_dataset) are packed into
+    <data>/cache:
+        frames.u8      every frame decoded, resized to 224x224 BGR, one after the other (uint8, opened with np.memmap)
+        labels.npy     label of every frame, 1 if the pellet is gone
+        manifest.json  for every frame: its file (relative to <data>), label, size, mtime and sha1 of the file
+
+    pack_dataset only decodes images it hasn't packed before. A file whose size and mtime match the manifest
+    is taken as unchanged without reading it; any other file is hashed, and a file with a known hash (e.g.
+    moved from 0/ to 1/) reuses its packed frame. Frames keep their place in the cache in manifest order and
+    new files go after them, whichever folder they are in, so if frames were only added they are appended to
+    frames.u8; if any were removed or moved, frames.u8 is rewritten from the old one without decoding. The manifest is
+    removed before the cache is changed and written back last, so a pack cut short is packed again from
+    scratch instead of leaving a manifest that doesn't match frames.u8.
+
+    open_dataset maps the cache in milliseconds; slicing the frames reads only those frames from disk.
+"""
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+from detector_input import INPUT_SIZE
+
+CACHE_FOLDER = 'cache'
+FRAME_SHAPE = (INPUT_SIZE, INPUT_SIZE, 3)
+FRAME_BYTES = INPUT_SIZE * INPUT_SIZE * 3
+MANIFEST_VERSION = 1
+
+
+def list_labelled(data_folder):
+    '''
+    :return: list of (image path, label) of the labelled frames in <data_folder>, label 1 if the pellet is gone
+    '''
+    items = []
+    for label in (0, 1):
+        folder = os.path.join(data_folder, str(label))
+        assert os.path.isdir(folder), "%s not found, see data_utils.generate_dataset" % folder
+        for name in sorted(os.listdir(folder)):
+            if name.lower().endswith(('.jpg', '.png')):
+                items.append((os.path.join(folder, name), label))
+    return items
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def decode(path):
+    image = cv2.imread(path)
+    if image is None:
+        raise IOError("Can't read %s" % path)
+    if image.shape[:2] != FRAME_SHAPE[:2]:
+        image = cv2.resize(image, FRAME_SHAPE[1::-1])
+    return image
+
+
+def cache_paths(data_folder):
+    cache_folder = os.path.join(data_folder, CACHE_FOLDER)
+    return (cache_folder, os.path.join(cache_folder, 'frames.u8'), os.path.join(cache_folder, 'labels.npy'),
+            os.path.join(cache_folder, 'manifest.json'))
+
+
+def load_manifest(manifest_path):
+    if not os.path.isfile(manifest_path):
+        return []
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('shape') != list(FRAME_SHAPE):
+        return []
+    return manifest['entries']
+
+
+def write_atomically(path, write):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def pack_dataset(data_folder):
+    '''
+    Bring <data_folder>/cache up to date with the labelled frames in <data_folder>.
+    :return: number of frames that had to be decoded
+    '''
+    cache_folder, frames_path, labels_path, manifest_path = cache_paths(data_folder)
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+    old_entries = load_manifest(manifest_path)
+    if not os.path.isfile(frames_path) or os.path.getsize(frames_path) < len(old_entries) * FRAME_BYTES:
+        old_entries = []
+    by_file = dict((entry['file'], k) for k, entry in enumerate(old_entries))
+    by_hash = dict((entry['sha1'], k) for k, entry in enumerate(old_entries))
+
+    # packed files still there first, in manifest order, then the new ones
+    labelled = dict((os.path.relpath(path, data_folder).replace(os.sep, '/'), label)
+                    for path, label in list_labelled(data_folder))
+    order = [entry['file'] for entry in old_entries if entry['file'] in labelled]
+    order += sorted(set(labelled) - set(order))
+
+    # for every labelled frame: its manifest entry and the row of the old cache it can be copied from (or None)
+    entries = []
+    sources = []
+    for relative in order:
+        label = labelled[relative]
+        path = os.path.join(data_folder, relative)
+        stat = os.stat(path)
+        k = by_file.get(relative)
+        if k is not None and old_entries[k]['size'] == stat.st_size and old_entries[k]['mtime'] == stat.st_mtime:
+            sha1 = old_entries[k]['sha1']
+        else:
+            sha1 = file_hash(path)
+            k = by_hash.get(sha1)
+        entries.append({'file': relative, 'label': label, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                        'sha1': sha1})
+        sources.append(k)
+
+    new_count = sum(1 for k in sources if k is None)
+    appended_only = sources[:len(old_entries)] == list(range(len(old_entries))) and \
+        all(k is None for k in sources[len(old_entries):])
+    if os.path.isfile(manifest_path) and appended_only and entries[:len(old_entries)] == old_entries and \
+            new_count == 0:
+        # nothing changed
+        return 0
+
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+    if appended_only:
+        # keep the packed frames, decode the new ones onto the end
+        with open(frames_path, 'r+b' if os.path.isfile(frames_path) else 'wb') as f:
+            f.truncate(len(old_entries) * FRAME_BYTES)
+            f.seek(0, os.SEEK_END)
+            for entry in entries[len(old_entries):]:
+                f.write(decode(os.path.join(data_folder, entry['file'])).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+    else:
+        old_frames = None
+        if old_entries:
+            old_frames = np.memmap(frames_path, dtype=np.uint8, mode='r', shape=(len(old_entries),) + FRAME_SHAPE)
+
+        temp_path = frames_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            for entry, k in zip(entries, sources):
+                if k is None:
+                    f.write(decode(os.path.join(data_folder, entry['file'])).tobytes())
+                else:
+                    f.write(old_frames[k].tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # the old frames have to be unmapped before the file can be replaced on Windows
+        del old_frames
+        os.replace(temp_path, frames_path)
+
+    labels = np.array([entry['label'] for entry in entries], dtype=np.uint8)
+    write_atomically(labels_path, lambda f: np.save(f, labels))
+    manifest = {'version': MANIFEST_VERSION, 'shape': list(FRAME_SHAPE), 'entries': entries}
+    write_atomically(manifest_path, lambda f: f.write(json.dumps(manifest, indent=1).encode()))
+    print("Packed %d frames into %s (%d decoded)" % (len(entries), cache_folder, new_count))
+    return new_count
+
+
+def open_dataset(data_folder, update=True):
+    '''
+    :param update: pack new labelled frames first
+    :return: (frames, labels, entries): frames a read only (n, 224, 224, 3) uint8 memmap, labels a uint8 array,
+             entries the manifest entry of every frame
+    '''
+    if update:
+        pack_dataset(data_folder)
+    cache_folder, frames_path, labels_path, manifest_path = cache_paths(data_folder)
+    entries = load_manifest(manifest_path)
+    labels = np.load(labels_path)
+    assert len(labels) == len(entries), "%s is out of date, pack it again" % cache_folder
+    if not entries:
+        return np.empty((0,) + FRAME_SHAPE, dtype=np.uint8), labels, entries
+    frames = np.memmap(frames_path, dtype=np.uint8, mode='r', shape=(len(entries),) + FRAME_SHAPE)
+    return frames, labels, entries
+
+
+if __name__ == '__main__':
+    import sys
+    pack_dataset(sys.argv[1] if len(sys.argv) > 1 else 'labeled_data')
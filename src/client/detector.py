@@ -12,6 +12,9 @@ import keras
 import os
 import keras.backend as K
 from data_utils import prepare_for_training
+from detector_input import Preprocessor
+from detector_config import load_detector_config, DEFAULT_THRESHOLD
+from training_data import labelled_sequences
 import numpy as np
 import cv2
 from keras.preprocessing.image import ImageDataGenerator
@@ -22,11 +25,17 @@ from keras.callbacks import TensorBoard
 
 # make sure youre using a relatively balanced training dataset
 class Detector():
-    def __init__(self, weights_path="None"):
+    def __init__(self, weights_path="None", roi=None):
+        # turns camera frames into the model's input, see detector_input.py
+        self.preprocess = Preprocessor(roi)
         self.weights_path = None
         if os.path.exists(weights_path):
             self.weights_path = weights_path
         self.model = self.get_model()
+        # scores above this mean the pellet is gone, picked by detector_calibration.py
+        self.threshold = DEFAULT_THRESHOLD
+        if self.weights_path:
+            self.threshold = load_detector_config(self.weights_path)['threshold']
 
     def get_model(self):
         '''
@@ -85,29 +94,51 @@ class Detector():
         self.model.fit_generator(datagen.flow(trX, trY, batch_size=batch_size), steps_per_epoch=step_per_epoch, epochs=epoch,
                                  callbacks=callBackList, validation_data=test_datagen.flow(teX, teY, batch_size=32), validation_steps=20)
 
+    def train_on_folder(self, data_folder, batch_size=32, epoch=20, split=0.1, workers=4):
+        '''
+        Train on the labelled frames in <data_folder> (0 and 1 folders), read from disk a batch at a time
+        (see training_data.py) instead of all at once, so the dataset doesn't have to fit in memory.
+        :param workers: threads decoding and augmenting batches while the model trains
+        '''
+        # same augmentation as train(), scaling to [0, 1] is done by the sequence
+        datagen = ImageDataGenerator(
+            rotation_range=15,
+            width_shift_range=0.1,
+            height_shift_range=0.1,
+            vertical_flip=True,
+        )
+        train_sequence, validation_sequence = labelled_sequences(data_folder, batch_size, split, augment=datagen)
+        callBackList = []
+        callBackList.append(keras.callbacks.ModelCheckpoint('model/model.h5', save_best_only=True))
+        self.model.fit_generator(train_sequence, epochs=epoch, callbacks=callBackList,
+                                 validation_data=validation_sequence, workers=workers,
+                                 use_multiprocessing=False, max_queue_size=2 * workers)
+
     def predict(self, images):
         result = self.model.predict(images / 255.)
         return result
 
     def predict_on_single_raw_image(self, opencv_image):
-        # pixel coords of pellet cam
-        start_row, start_col = int(720 - 448), int((1280 // 2) - (448 // 2))
-        end_row, end_col = int(720), int((1280 // 2) + (448 // 2))
-        opencv_image = opencv_image[start_row:end_row, start_col:end_col]
+        return self.model.predict(self.preprocess([opencv_image]))[0]
+
+    def score_batch(self, opencv_images):
+        '''
+        Pellet detector scores for a batch of full camera frames (BGR or grayscale), one forward pass.
+        :return: float array with one score per frame, above self.threshold means the pellet is gone
+        '''
+        return self.score_inputs(self.preprocess(opencv_images))
+
+    def score_inputs(self, predict_images):
+        '''
+        Scores for a batch already in the model's input format, float32 (n, 224, 224, 3) scaled to [0, 1].
+        '''
+        return self.model.predict(predict_images, batch_size=len(predict_images)).ravel()
 
-        predict_image = np.asarray([cv2.resize(opencv_image, (224, 224))])
-        predict_image = predict_image / 255.
-        return self.model.predict(predict_image)[0]
+    def score_in_real_use(self, opencv_image):
+        return float(self.score_batch([opencv_image])[0])
 
     def predict_in_real_use(self, opencv_image):
-        # pixel coords of pellet cam
-        start_row, start_col = int(720 - 448), int((1280 // 2) - (448 // 2))
-        end_row, end_col = int(720), int((1280 // 2) + (448 // 2))
-        opencv_image = opencv_image[start_row:end_row, start_col:end_col]
-
-        predict_image = np.asarray([cv2.resize(opencv_image, (224, 224))])
-        predict_image = predict_image / 255.
-        if self.model.predict(predict_image)[0] > 0.5:
+        if self.score_in_real_use(opencv_image) > self.threshold:
             return True
         return False
 
@@ -124,7 +155,7 @@ def test_on_video(video_file):
             result = d.predict_on_single_raw_image(frame)[0]
             cv2.putText(frame, str(result), (0, 0), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), lineType=cv2.LINE_AA)
             # cv2.putText(frame,"Confidence: %.4f" % result, (0, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), lineType=cv2.LINE_AA)
-            if result > 0.5:
+            if result > d.threshold:
                 cv2.putText(frame, "Display" % result, (0, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0),
                             lineType=cv2.LINE_AA)
             else:
@@ -157,10 +188,8 @@ if __name__ == '__main__':
         #
         # output_folder = "/mnt/4T/pellet_output"
         output_folder = 'labeled_data'
-        x, y = prepare_for_training(output_folder)
-        print(x.shape)
-        print(y.shape)
-        d.train(x, y)
+        # streams the frames from disk, prepare_for_training + d.train(x, y) loads them all into memory
+        d.train_on_folder(output_folder)
         # # #
         # print(d.predict(x[10: 20, :, : ,:]))
         # print(y[10: 20])
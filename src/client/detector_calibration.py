@@ -0,0 +1,170 @@
+"""
+    Evaluates a trained pellet detector on the labelled frames and picks its "pellet gone" threshold.
+
+    The frames come from data_utils.generate_dataset: <data>/1 holds frames where the pellet is gone
+    (positives), <data>/0 frames where it is still there. Each image is the detector's ROI of a frame (see
+    labelling_tool.py), the input the threshold gates at run time; folders labelled with whole frames by the
+    old generate_dataset have to be labelled again. They are read from the dataset cache
+    (dataset_cache.py) and all of them are scored in batches, then:
+        - the ROC and precision/recall curves are written to <out>/curves.csv (and plotted to
+          <out>/curves.png when matplotlib is installed)
+        - the inference time per frame is reported as percentiles
+        - every threshold is given a cost in wasted seconds: a false "pellet gone" sends the arm through a
+          whole presentation cycle for nothing (--fp-cost seconds), a missed "pellet gone" keeps the arm up
+          until the next look (--fn-cost seconds). The cheapest threshold is written to the model's
+          <model file>.config.json (see detector_config.py), which Detector and RuntimeDetector load.
+
+    Usage:
+        python detector_calibration.py --model model/model.h5 --data labeled_data [--dry-run]
+"""
+import argparse
+import datetime
+import os
+import time
+
+import numpy as np
+
+from dataset_cache import open_dataset
+from detector_config import save_detector_config, load_detector_config
+from detector_input import INPUT_SIZE
+
+
+def load_model(model_path):
+    if model_path.endswith('.h5'):
+        from detector import Detector
+        return Detector(model_path)
+    from detector_runtime import RuntimeDetector
+    return RuntimeDetector(model_path)
+
+
+def score_labelled(detector, frames, batch_size=16):
+    '''
+    Score every labelled frame, <batch_size> frames per forward pass.
+    :return: scores, and the inference time per frame (seconds) of every batch
+    '''
+    scores = np.empty(len(frames), dtype=np.float32)
+    batch = np.empty((batch_size, INPUT_SIZE, INPUT_SIZE, 3), dtype=np.float32)
+    per_frame = []
+    for start in range(0, len(frames), batch_size):
+        chunk = frames[start:start + batch_size]
+        np.multiply(chunk, np.float32(1. / 255.), out=batch[:len(chunk)], casting='unsafe')
+        begin = time.perf_counter()
+        scores[start:start + len(chunk)] = detector.score_inputs(batch[:len(chunk)])
+        per_frame.append((time.perf_counter() - begin) / len(chunk))
+    return scores, np.asarray(per_frame)
+
+
+def sweep(scores, labels, fp_cost, fn_cost):
+    '''
+    Confusion counts for every threshold that changes a decision (a frame counts as "pellet gone" when its
+    score is above the threshold).
+    :return: dict of arrays, thresholds in decreasing order
+    '''
+    positives = np.sort(scores[labels == 1])
+    negatives = np.sort(scores[labels == 0])
+    thresholds = np.unique(np.concatenate([[0., 1.], scores]))[::-1]
+    tp = len(positives) - np.searchsorted(positives, thresholds, side='right')
+    fp = len(negatives) - np.searchsorted(negatives, thresholds, side='right')
+    fn = len(positives) - tp
+    predicted = tp + fp
+    precision = np.where(predicted > 0, tp / np.maximum(predicted, 1).astype(np.float64), 1.)
+    return {
+        'threshold': thresholds,
+        'tp': tp,
+        'fp': fp,
+        'fn': fn,
+        'fpr': fp / float(max(len(negatives), 1)),
+        'tpr': tp / float(max(len(positives), 1)),
+        'precision': precision,
+        'wasted_seconds': fp * fp_cost + fn * fn_cost,
+    }
+
+
+def area(x, y):
+    # trapezoid rule, x increasing
+    return float(np.sum((x[1:] - x[:-1]) * (y[1:] + y[:-1]) / 2.))
+
+
+def write_curves(curves, out_folder):
+    path = os.path.join(out_folder, 'curves.csv')
+    names = ['threshold', 'fpr', 'tpr', 'precision', 'tp', 'fp', 'fn', 'wasted_seconds']
+    np.savetxt(path, np.column_stack([curves[name] for name in names]), delimiter=',',
+               header=','.join(names), comments='', fmt='%.6g')
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return path
+    figure, (roc, pr) = plt.subplots(1, 2, figsize=(10, 5))
+    roc.plot(curves['fpr'], curves['tpr'])
+    roc.set_xlabel('false positive rate')
+    roc.set_ylabel('true positive rate')
+    roc.set_title('ROC')
+    pr.plot(curves['tpr'], curves['precision'])
+    pr.set_xlabel('recall')
+    pr.set_ylabel('precision')
+    pr.set_title('Precision/recall')
+    figure.savefig(os.path.join(out_folder, 'curves.png'))
+    plt.close(figure)
+    return path
+
+
+def calibrate(model_path, data_folder, out_folder, fp_cost=5.0, fn_cost=0.5, batch_size=16, dry_run=False):
+    frames, labels, _ = open_dataset(data_folder)
+    print("%d labelled frames (%d pellet gone)" % (len(labels), labels.sum()))
+    detector = load_model(model_path)
+    scores, per_frame = score_labelled(detector, frames, batch_size)
+
+    curves = sweep(scores, labels, fp_cost, fn_cost)
+    roc_auc = area(curves['fpr'], curves['tpr'])
+    average_precision = float(np.sum(np.diff(np.concatenate([[0.], curves['tpr']])) * curves['precision']))
+    best = int(np.argmin(curves['wasted_seconds']))
+    threshold = float(curves['threshold'][best])
+    current = load_detector_config(model_path)['threshold']
+    at_current = int(np.searchsorted(-curves['threshold'], -current, side='left'))
+
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    curves_path = write_curves(curves, out_folder)
+
+    percentiles = np.percentile(per_frame * 1000., [50, 90, 99])
+    print("Inference per frame: p50 %.2f ms, p90 %.2f ms, p99 %.2f ms (batches of %d)" %
+          (percentiles[0], percentiles[1], percentiles[2], batch_size))
+    print("ROC AUC %.4f, average precision %.4f, curves in %s" % (roc_auc, average_precision, curves_path))
+    for name, value, index in (('current', current, at_current), ('best', threshold, best)):
+        print("%s threshold %.4f: %d false 'pellet gone', %d missed, %.1f s wasted" %
+              (name, value, curves['fp'][index], curves['fn'][index], curves['wasted_seconds'][index]))
+
+    if dry_run:
+        return threshold
+    config = load_detector_config(model_path)
+    config.update({
+        'threshold': threshold,
+        'calibrated_on': os.path.abspath(data_folder),
+        'calibrated_at': datetime.datetime.now().isoformat(),
+        'frames': len(labels),
+        'roc_auc': roc_auc,
+        'average_precision': average_precision,
+        'fp_cost': fp_cost,
+        'fn_cost': fn_cost,
+    })
+    print("Threshold written to %s" % save_detector_config(model_path, config))
+    return threshold
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='trained detector (.h5, .tflite or .onnx)', default='model/model.h5')
+    parser.add_argument('--data', help='folder with the 0 and 1 folders of labelled frames', default='labeled_data')
+    parser.add_argument('--out', help='folder the curves are written to', default='calibration')
+    parser.add_argument('--fp-cost', help='seconds lost to a false "pellet gone"', dest='fp_cost', type=float,
+                        default=5.0)
+    parser.add_argument('--fn-cost', help='seconds lost to a missed "pellet gone"', dest='fn_cost', type=float,
+                        default=0.5)
+    parser.add_argument('--batch', help='frames per forward pass', type=int, default=16)
+    parser.add_argument('--dry-run', help="report only, don't write the threshold", dest='dry_run',
+                        action='store_true')
+    args = parser.parse_args()
+
+    calibrate(args.model, args.data, args.out, args.fp_cost, args.fn_cost, args.batch, args.dry_run)
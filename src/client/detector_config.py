@@ -0,0 +1,42 @@
+"""
+    Settings that go with a trained pellet detector, kept next to the model file in <model file>.config.json
+    (model.h5.config.json, model.tflite.config.json...). Each model file gets its own: an exported model
+    scores a little differently from the Keras model it came from, so it is calibrated on its own.
+
+    The score above which a frame counts as "pellet gone" is picked per model by detector_calibration.py,
+    from the model's scores on the labelled frames, and written here. Detector and RuntimeDetector read it
+    when they load the model. Without a config file the threshold is DEFAULT_THRESHOLD.
+"""
+import json
+import os
+
+CONFIG_SUFFIX = '.config.json'
+DEFAULT_THRESHOLD = 0.5
+
+
+def detector_config_path(model_path):
+    return os.path.abspath(model_path) + CONFIG_SUFFIX
+
+
+def load_detector_config(model_path):
+    '''
+    :return: dict of the settings for the model at <model_path>, with at least 'threshold'
+    '''
+    config = {'threshold': DEFAULT_THRESHOLD}
+    path = detector_config_path(model_path)
+    if os.path.isfile(path):
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+def save_detector_config(model_path, config):
+    # written to a temp file first so a detector loading at the same time never reads half a file
+    path = detector_config_path(model_path)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(config, f, indent=4, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return path
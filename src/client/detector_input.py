@@ -0,0 +1,71 @@
+"""
+    Turns camera frames into the pellet detector's input (used by detector.py and detector_runtime.py).
+
+    Only the region of the frame around the pellet (ROI) is looked at. Per frame, the ROI is a view into the
+    frame (no copy), it is resized into a reused uint8 buffer, and a single numpy pass converts that buffer to
+    float32, scales it to [0, 1] and writes it into a reused input batch. Grayscale frames are broadcast to the
+    3 channels the detector was trained on in that same pass, instead of being converted to BGR first.
+"""
+import cv2
+import numpy as np
+
+INPUT_SIZE = 224
+
+
+class ROI(object):
+    '''
+    Square region of the camera frame the pellet sits in.
+    :param top: first row of the region
+    :param left: first column of the region
+    :param size: side of the region in pixels, resized to <input_size> for the detector
+    '''
+    def __init__(self, top=720 - 448, left=(1280 // 2) - (448 // 2), size=448, input_size=INPUT_SIZE):
+        self.top = top
+        self.left = left
+        self.size = size
+        self.input_size = input_size
+
+    def crop(self, frame):
+        '''
+        :return: view of the region in <frame>
+        '''
+        if frame.shape[0] < self.top + self.size or frame.shape[1] < self.left + self.size:
+            raise ValueError("Frame of shape %s does not contain the detector ROI %s" % (frame.shape, self))
+        return frame[self.top:self.top + self.size, self.left:self.left + self.size]
+
+    def __repr__(self):
+        return "ROI(top=%d, left=%d, size=%d, input_size=%d)" % (self.top, self.left, self.size, self.input_size)
+
+
+# pixel coords of pellet cam
+PELLET_CAM_ROI = ROI()
+
+
+class Preprocessor(object):
+    '''
+    Fills a reused float32 batch of shape (n, input_size, input_size, 3) from full camera frames.
+    Not thread safe: every thread scoring frames needs its own Preprocessor.
+    '''
+    def __init__(self, roi=None):
+        self.roi = roi or PELLET_CAM_ROI
+        size = self.roi.input_size
+        self.resized = {2: np.empty((size, size), dtype=np.uint8), 3: np.empty((size, size, 3), dtype=np.uint8)}
+        self.batch = np.empty((0, size, size, 3), dtype=np.float32)
+
+    def __call__(self, frames):
+        '''
+        :param frames: sequence of uint8 frames, BGR or grayscale
+        :return: the batch for <frames>, values scaled to [0, 1]. Only valid until the next call.
+        '''
+        n = len(frames)
+        if self.batch.shape[0] < n:
+            size = self.roi.input_size
+            self.batch = np.empty((n, size, size, 3), dtype=np.float32)
+        out = self.batch[:n]
+        size = self.roi.input_size
+        for i, frame in enumerate(frames):
+            resized = cv2.resize(self.roi.crop(frame), (size, size), dst=self.resized[frame.ndim])
+            if resized.ndim == 2:
+                resized = resized[:, :, np.newaxis]
+            np.multiply(resized, np.float32(1. / 255.), out=out[i], casting='unsafe')
+        return out
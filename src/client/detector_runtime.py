@@ -0,0 +1,250 @@
+"""
+    Runs the trained pellet detector without Keras.
+
+    Detector (detector.py) builds the whole Keras graph, fetches the MobileNetV2 ImageNet weights and compiles
+    an optimizer before it can score one frame. The cage PCs only need the forward pass, so the trained model
+    is exported once to a quantised TFLite or ONNX file and RuntimeDetector loads that file with only the
+    small runtime package (tflite_runtime or onnxruntime, see dependencies/runtime_requirements.txt).
+
+    Exporting needs TensorFlow 2.5 (TensorFlow 1.10 has no post-training integer quantisation and no ONNX
+    converter), so it runs in its own environment, see dependencies/export_requirements.txt. collect and
+    parity run in the cage PC's environment.
+
+    Usage:
+        python detector_runtime.py export --weights model/model.h5 --out model/model.tflite [--frames frames.npz]
+        python detector_runtime.py export --weights model/model.h5 --out model/model.onnx
+        python detector_runtime.py collect --video some_session.avi --out model/parity_frames.npz
+        python detector_runtime.py parity --weights model/model.h5 --model model/model.tflite --frames model/parity_frames.npz
+
+    export: with --frames and a .tflite output, the frames are used to calibrate full integer quantisation,
+            otherwise the weights are quantised to 8 bits and the activations stay float.
+    collect: samples frames from a video into a frame set.
+    parity: scores the frame set with the Keras model and the exported model and compares them. Exits with
+            status 1 if the scores differ by more than --tolerance or the pellet/no pellet decision differs on
+            more than --max-disagreement of the frames. With --video and no frame set at --frames yet, the
+            frame set is collected from the video first.
+
+    The repo has no test suite and no session videos, so the parity check is the deployment gate instead of
+    a unit test: after exporting a model, on the cage PC,
+        python detector_runtime.py parity --weights model/model.h5 --model model/model.tflite \
+            --frames model/parity_frames.npz --video <a session video from this cage>
+    and only switch DETECTOR_MODEL in main.py to the exported file if it prints "Parity OK". Keep
+    model/parity_frames.npz next to the model so later exports are checked against the same frames.
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from detector_input import Preprocessor, INPUT_SIZE
+from detector_config import load_detector_config
+
+
+class RuntimeDetector(object):
+    '''
+    Same scoring interface as Detector, backed by an exported .tflite or .onnx model.
+    :param model_path: file written by export_model
+    :param threads: CPU threads the runtime may use
+    :param roi: detector_input.ROI the pellet is in, the pellet cam's by default
+    '''
+    def __init__(self, model_path, threads=2, roi=None):
+        self.model_path = model_path
+        self.preprocess = Preprocessor(roi)
+        # scores above this mean the pellet is gone, picked by detector_calibration.py
+        self.threshold = load_detector_config(model_path)['threshold']
+        self.backend = os.path.splitext(model_path)[1].lower()
+        if self.backend == '.tflite':
+            try:
+                from tflite_runtime.interpreter import Interpreter
+            except ImportError:
+                # TensorFlow 2 ships the same interpreter, the cage PCs' TensorFlow 1.10 doesn't
+                import tensorflow as tf
+                if not hasattr(tf, 'lite') or not hasattr(tf.lite, 'Interpreter'):
+                    raise ImportError("Running %s needs tflite_runtime, see dependencies/runtime_requirements.txt"
+                                      % model_path)
+                Interpreter = tf.lite.Interpreter
+            self.interpreter = Interpreter(model_path=model_path, num_threads=threads)
+            self.input = self.interpreter.get_input_details()[0]
+            self.output = self.interpreter.get_output_details()[0]
+            self.batch_size = None
+        elif self.backend == '.onnx':
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+        else:
+            raise ValueError("Unknown detector model format: %s" % model_path)
+
+    def score_batch(self, opencv_images):
+        '''
+        Pellet detector scores for a batch of full camera frames (BGR or grayscale), one forward pass.
+        :return: float array with one score per frame, above self.threshold means the pellet is gone
+        '''
+        return self.score_inputs(self.preprocess(opencv_images))
+
+    def score_inputs(self, images):
+        '''
+        Scores for a batch already in the model's input format, float32 (n, 224, 224, 3) scaled to [0, 1].
+        '''
+        if self.backend == '.onnx':
+            return self.session.run(None, {self.input_name: images})[0].ravel()
+        return self.invoke_tflite(images)
+
+    def invoke_tflite(self, images):
+        if self.batch_size != images.shape[0]:
+            self.interpreter.resize_tensor_input(self.input['index'], list(images.shape))
+            self.interpreter.allocate_tensors()
+            self.batch_size = images.shape[0]
+        if self.input['dtype'] != np.float32:
+            # fully quantised model, integer input
+            scale, zero_point = self.input['quantization']
+            images = np.round(images / scale + zero_point).astype(self.input['dtype'])
+        self.interpreter.set_tensor(self.input['index'], images)
+        self.interpreter.invoke()
+        scores = self.interpreter.get_tensor(self.output['index']).ravel()
+        if self.output['dtype'] != np.float32:
+            scale, zero_point = self.output['quantization']
+            scores = (scores.astype(np.float32) - zero_point) * scale
+        return scores
+
+    def score_in_real_use(self, opencv_image):
+        return float(self.score_batch([opencv_image])[0])
+
+    def predict_in_real_use(self, opencv_image):
+        if self.score_in_real_use(opencv_image) > self.threshold:
+            return True
+        return False
+
+
+def export_model(weights_path, out_path, frames=None):
+    '''
+    Convert the trained Keras detector to a quantised .tflite or .onnx file (picked from <out_path>).
+    Runs in the export environment (dependencies/export_requirements.txt).
+    :param frames: raw camera frames to calibrate full integer quantisation with (TFLite only)
+    '''
+    import tensorflow as tf
+    if int(tf.__version__.split('.')[0]) < 2:
+        raise RuntimeError("Exporting needs TensorFlow 2.5 (found %s), see dependencies/export_requirements.txt"
+                           % tf.__version__)
+    from detector import Detector
+    model = Detector(weights_path).model
+    if out_path.endswith('.tflite'):
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if frames is not None:
+            preprocess = Preprocessor()
+
+            def representative_dataset():
+                for frame in frames:
+                    yield [preprocess([frame])]
+            converter.representative_dataset = representative_dataset
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            converter.inference_input_type = tf.uint8
+            converter.inference_output_type = tf.uint8
+        with open(out_path, 'wb') as f:
+            f.write(converter.convert())
+    elif out_path.endswith('.onnx'):
+        import tf2onnx
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        spec = (tf.TensorSpec((None, INPUT_SIZE, INPUT_SIZE, 3), tf.float32, name='input'),)
+        float_path = out_path[:-len('.onnx')] + '_float.onnx'
+        tf2onnx.convert.from_keras(model, input_signature=spec, opset=13, output_path=float_path)
+        quantize_dynamic(float_path, out_path, weight_type=QuantType.QUInt8)
+        os.remove(float_path)
+    else:
+        raise ValueError("Export to .tflite or .onnx, not %s" % out_path)
+    print("Exported %s to %s (%.1f MB)" % (weights_path, out_path, os.path.getsize(out_path) / 1e6))
+    print("Pick its threshold with: python detector_calibration.py --model %s" % out_path)
+
+
+def collect_frames(video_path, out_path, every=30, limit=200):
+    '''
+    Save every <every>th frame of a session video (up to <limit> frames) as a frame set for parity checks.
+    '''
+    stream = cv2.VideoCapture(video_path)
+    frames = []
+    frame_cnt = 0
+    while len(frames) < limit:
+        grab, frame = stream.read()
+        if not grab:
+            break
+        if frame_cnt % every == 0:
+            frames.append(frame)
+        frame_cnt += 1
+    stream.release()
+    np.savez_compressed(out_path, frames=np.asarray(frames))
+    print("Saved %d frames to %s" % (len(frames), out_path))
+
+
+def time_scores(detector, frames, batch_size):
+    # scores of all frames and the mean time per frame in ms
+    scores = []
+    start = time.perf_counter()
+    for i in range(0, len(frames), batch_size):
+        scores.append(detector.score_batch(frames[i:i + batch_size]))
+    elapsed = time.perf_counter() - start
+    return np.concatenate(scores), 1000. * elapsed / len(frames)
+
+
+def check_parity(weights_path, model_path, frames, batch_size=4, tolerance=0.05, max_disagreement=0.01):
+    '''
+    Compare the exported model's scores with the Keras model's on <frames>.
+    :return: True if the exported model can stand in for the Keras model
+    '''
+    from detector import Detector
+    start = time.perf_counter()
+    runtime = RuntimeDetector(model_path)
+    runtime_load = time.perf_counter() - start
+    start = time.perf_counter()
+    reference = Detector(weights_path)
+    keras_load = time.perf_counter() - start
+
+    expected, keras_ms = time_scores(reference, frames, batch_size)
+    actual, runtime_ms = time_scores(runtime, frames, batch_size)
+    difference = np.abs(expected - actual)
+    # each model decides with its own calibrated threshold
+    disagreement = np.mean((expected > reference.threshold) != (actual > runtime.threshold))
+    print("Frames: %d" % len(frames))
+    print("Load time: keras %.2f s, %s %.3f s" % (keras_load, runtime.backend, runtime_load))
+    print("Per frame: keras %.1f ms, %s %.1f ms" % (keras_ms, runtime.backend, runtime_ms))
+    print("Score difference: mean %.4f, max %.4f (tolerance %.4f)" % (difference.mean(), difference.max(), tolerance))
+    print("Decisions that differ: %.2f%% (limit %.2f%%)" % (100. * disagreement, 100. * max_disagreement))
+    return difference.max() <= tolerance and disagreement <= max_disagreement
+
+
+def load_frames(path):
+    with np.load(path) as data:
+        return data['frames']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['export', 'collect', 'parity'])
+    parser.add_argument('--weights', help='trained Keras weights', default='model/model.h5')
+    parser.add_argument('--model', help='exported .tflite or .onnx model', default='model/model.tflite')
+    parser.add_argument('--out', help='output file of export or collect')
+    parser.add_argument('--frames', help='frame set (.npz) written by collect')
+    parser.add_argument('--video', help='session video to collect frames from')
+    parser.add_argument('--every', help='collect every nth frame', type=int, default=30)
+    parser.add_argument('--batch', help='frames per forward pass in the parity check', type=int, default=4)
+    parser.add_argument('--tolerance', help='largest score difference allowed', type=float, default=0.05)
+    parser.add_argument('--max-disagreement', help='fraction of frames allowed to get a different decision',
+                        dest='max_disagreement', type=float, default=0.01)
+    args = parser.parse_args()
+
+    if args.action == 'export':
+        export_model(args.weights, args.out or args.model, load_frames(args.frames) if args.frames else None)
+    elif args.action == 'collect':
+        collect_frames(args.video, args.out or 'model/parity_frames.npz', args.every)
+    else:
+        frames_path = args.frames or 'model/parity_frames.npz'
+        if not os.path.isfile(frames_path) and args.video:
+            collect_frames(args.video, frames_path, args.every)
+        ok = check_parity(args.weights, args.model, load_frames(frames_path), args.batch, args.tolerance,
+                          args.max_disagreement)
+        print("Parity OK" if ok else "Parity FAILED")
+        sys.exit(0 if ok else 1)
@@ -0,0 +1,124 @@
+"""
+    Runs the pellet detector on its own thread, next to the session loop instead of inside it.
+
+    The worker takes the newest frames from the shared frame channel (frame_channel.py), a few at a time:
+    it waits for one new frame, then collects whatever else arrives within <max_wait> seconds, up to
+    <batch_size> frames, and scores them in one forward pass. Every score is published as
+    (frame sequence number, capture time, score) on <results> and kept as the latest result, so the session
+    loop can look at the detector's current opinion without waiting for it, and passed to the subscribed
+    callbacks (e.g. pellet_tracker.py) as it comes out. The camera runs much faster
+    than the detector, so frames that arrive while a batch is being scored are skipped.
+"""
+import time
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+
+import numpy as np
+
+
+class DetectorWorker(object):
+    '''
+    :param channel: SharedFrameChannel the recorder publishes frames into
+    :param detector: object with a score_batch(frames) method (detector.Detector)
+    :param batch_size: most frames scored in one forward pass
+    :param max_wait: seconds to wait for more frames once the first frame of a batch is in
+    '''
+    def __init__(self, channel, detector, batch_size=4, max_wait=0.05, queue_size=256):
+        self.channel = channel
+        self.detector = detector
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.frames = np.empty((batch_size,) + channel.shape, dtype=np.uint8)
+        self.results = Queue(maxsize=queue_size)
+        self.latest_result = None
+        self.lock = Lock()
+        self.subscribers = []
+        self.last_seq = channel.sequence()
+        self.batches = 0
+        self.scored = 0
+        self.inference_time = 0.
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def subscribe(self, callback):
+        '''
+        Have callback(seq, timestamp, score) called from the worker thread for every frame scored.
+        '''
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def stop(self):
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join(2.0)
+
+    def collect(self):
+        # fill self.frames with up to batch_size new frames, returns [(seq, timestamp)] of the frames taken
+        batch = []
+        timeout = 0.5
+        deadline = None
+        while len(batch) < self.batch_size and not self.stopped:
+            latest = self.channel.latest(newer_than=self.last_seq, timeout=timeout, out=self.frames[len(batch)])
+            if latest is None:
+                break
+            seq, timestamp, _ = latest
+            self.last_seq = seq
+            batch.append((seq, timestamp))
+            if deadline is None:
+                deadline = time.perf_counter() + self.max_wait
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+        return batch
+
+    def run(self):
+        while not self.stopped:
+            batch = self.collect()
+            if not batch:
+                continue
+            start = time.perf_counter()
+            scores = self.detector.score_batch(self.frames[:len(batch)])
+            self.inference_time += time.perf_counter() - start
+            self.batches += 1
+            self.scored += len(batch)
+            for (seq, timestamp), score in zip(batch, scores):
+                self.publish((seq, timestamp, float(score)))
+
+    def publish(self, result):
+        with self.lock:
+            self.latest_result = result
+        try:
+            self.results.put_nowait(result)
+        except Full:
+            # nobody is reading the queue, keep the newest results
+            try:
+                self.results.get_nowait()
+            except Empty:
+                pass
+            self.results.put_nowait(result)
+        for callback in list(self.subscribers):
+            callback(*result)
+
+    def latest(self, newer_than=0):
+        '''
+        :return: (seq, timestamp, score) of the most recently scored frame if its sequence number is above
+                 <newer_than>, None otherwise. Never blocks on the detector.
+        '''
+        with self.lock:
+            result = self.latest_result
+        if result is None or result[0] <= newer_than:
+            return None
+        return result
+
+    def stats(self):
+        return {'batches': self.batches, 'scored': self.scored,
+                'ms_per_frame': 1000. * self.inference_time / self.scored if self.scored else None}
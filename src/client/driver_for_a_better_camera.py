@@ -9,8 +9,9 @@
     2. Save frames into a video file.
 """
 import datetime
-from threading import Thread
+from threading import Thread, Condition, Event, Lock
 import cv2
+import numpy as np
 import time
 import inspect
 import ctypes
@@ -18,10 +19,10 @@ import argparse
 import platform
 import pickle
 import os
+from frame_channel import SharedFrameChannel, CaptureClock
+from video_writers import make_writer, npy_header
 
 
-DETECT_FLAG = False
-
 class FPS_camera:
     def __init__(self):
         self._start = None
@@ -52,11 +53,161 @@ class FPS_camera:
         return self._numFrames / self.elapsed()
 
 
+class FrameRing:
+    '''
+    Fixed capacity ring of preallocated frame buffers between the capture thread (producer)
+    and the recording thread (consumer). The capture thread writes each grayscale frame straight
+    into a ring slot, and every committed frame is handed to the consumer exactly once, in order.
+
+    If the consumer falls a full ring behind, new frames are dropped (and counted) instead of
+    overwriting frames that have not been recorded yet.
+
+    While nobody is consuming (between sessions) the ring keeps the most recent frames as a
+    pre-roll buffer, recycling the oldest one for each new frame. start_consuming() then starts
+    the consumer a few seconds in the past, but never reaches back into the newest <slack> slots' worth
+    of the ring, so the capture thread still has free slots while the recorder works through the pre-roll.
+    '''
+    def __init__(self, shape, capacity=64, slack=0):
+        assert slack < capacity, "slack has to leave room for at least one frame"
+        self.capacity = capacity
+        self.slack = slack
+        self.frames = np.empty((capacity,) + tuple(shape), dtype=np.uint8)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.drops = np.zeros(capacity, dtype=np.uint16)
+        self._drops_since_commit = 0
+        self.written = 0    # frames committed by the producer
+        self.consumed = 0   # frames handed out to the consumer
+        self.released = 0   # frames the consumer is done with
+        self.dropped = 0    # frames the camera delivered but the ring had no room for
+        self.consuming = True
+        self.cond = Condition()
+
+    def write_slot(self):
+        # Buffer to decode the next frame into, or None if every slot is still in use
+        if self.written - self.released >= self.capacity:
+            if self.consuming:
+                return None
+            with self.cond:
+                # pre-roll only: give up the oldest frame
+                self.consumed = self.released = self.written - self.capacity + 1
+        return self.frames[self.written % self.capacity]
+
+    def start_consuming(self, since):
+        '''
+        Make get() start at the oldest buffered frame captured at or after <since>
+        (time.time() clock), or at the oldest buffered frame if the ring doesn't reach back that far.
+        '''
+        with self.cond:
+            first = self.written
+            oldest = max(self.released, self.written - self.capacity + 1 + self.slack, 0)
+            while first > oldest and self.timestamps[(first - 1) % self.capacity] >= since:
+                first -= 1
+            self.consumed = self.released = first
+            self.consuming = True
+
+    def stop_consuming(self):
+        with self.cond:
+            self.released = self.consumed
+            self.consuming = False
+
+    def commit(self, timestamp):
+        with self.cond:
+            self.timestamps[self.written % self.capacity] = timestamp
+            self.drops[self.written % self.capacity] = min(self._drops_since_commit, 65535)
+            self._drops_since_commit = 0
+            self.written += 1
+            self.cond.notify()
+
+    def drop(self):
+        with self.cond:
+            self.dropped += 1
+            self._drops_since_commit += 1
+
+    def get(self, timeout=None):
+        '''
+        Hand out the oldest frame that has not been consumed yet.
+        The returned frame is a view into the ring and stays valid until the next call to get().
+        :return: (frame, capture timestamp, frames dropped right before this one)
+                 or None if no frame arrived within <timeout> seconds
+        '''
+        with self.cond:
+            # the frame handed out last time can be reused by the producer now
+            self.released = self.consumed
+            if not self.cond.wait_for(lambda: self.consuming and self.written > self.consumed, timeout):
+                return None
+            index = self.consumed % self.capacity
+            self.consumed += 1
+            return self.frames[index], self.timestamps[index], self.drops[index]
+
+    def latest(self):
+        # most recently committed frame, without consuming it
+        if self.written == 0:
+            return None
+        return self.frames[(self.written - 1) % self.capacity]
+
+    def pending(self):
+        return self.written - self.consumed
+
+
+def timestamp_path(video_path):
+    # sidecar file holding the capture timestamps of every frame in <video_path>
+    return os.path.splitext(video_path)[0] + '.ts.npy'
+
+
+class FrameTimestampWriter:
+    '''
+    Streams one record per recorded frame into a .npy file:
+        timestamp: capture time in seconds (time.time() clock, see frame_channel.CaptureClock)
+        dropped:   number of camera frames dropped right before this frame (0 = none)
+
+    Records are buffered and appended in blocks, and the array length in the .npy header is
+    patched on close, so the file can be read back with np.load(path).
+    '''
+    dtype = np.dtype([('timestamp', '<f8'), ('dropped', '<u2')])
+
+    def __init__(self, path, block_size=1024):
+        self.path = path
+        self.count = 0
+        self.block = np.zeros(block_size, dtype=self.dtype)
+        self.filled = 0
+        self.file = open(path, 'wb')
+        self.file.write(npy_header(self.dtype, (0,)))
+
+    def append(self, timestamp, dropped=0):
+        self.block[self.filled] = (timestamp, dropped)
+        self.filled += 1
+        self.count += 1
+        if self.filled == self.block.shape[0]:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.block[:self.filled].tobytes())
+        self.filled = 0
+
+    def close(self):
+        self.flush()
+        self.file.seek(0)
+        self.file.write(npy_header(self.dtype, (self.count,)))
+        self.file.close()
+
+
+# Capture modes. Only the luminance is ever recorded, so the frame is reduced to grayscale once,
+# in the capture thread, straight into the ring slot.
+#   bgr:       let OpenCV decode to BGR (into a reused buffer) and convert to gray. Works with every camera.
+#   mjpg_gray: ask for MJPG and decode only the luminance of the raw JPEG, skipping the colour conversion.
+#   yuyv:      ask for uncompressed YUYV and copy every other byte (the Y plane). Needs USB bandwidth, so
+#              usually only reaches high frame rates at lower resolutions.
+CAPTURE_MODES = ('bgr', 'mjpg_gray', 'yuyv')
+
+
 class WebcamVideoStream:
-    def __init__(self, src=0, width=1280, height=720):
+    def __init__(self, src=0, width=1280, height=720, ring_capacity=64, capture_mode='bgr', ring_slack=0):
+        assert capture_mode in CAPTURE_MODES, "Unknown capture mode: %s" % capture_mode
+        self.capture_mode = capture_mode
         # If you are under windows system using Dshow as backend
         if platform.system() == 'Windows':
             self.stream = cv2.VideoCapture(src, cv2.CAP_DSHOW)
+            self.set_capture_mode()
             # print(self.stream.isOpened())
             self.width = width
             self.height = height
@@ -68,6 +219,7 @@ class WebcamVideoStream:
         # If not go next line
         else:
             self.stream = cv2.VideoCapture(src)
+            self.set_capture_mode()
             # print(self.stream.isOpened())
             self.width = width
             self.height = height
@@ -83,7 +235,12 @@ class WebcamVideoStream:
         ret8 = self.stream.set(cv2.CAP_PROP_CONTRAST, 0)
         print(ret1, ret2, ret3, ret4, ret5, ret6, ret7, ret8)
 
+        # the first frame also becomes the reusable buffer every later frame is decoded into
         (self.grabbed, self.frame) = self.stream.read()
+        shape = (int(self.stream.get(cv2.CAP_PROP_FRAME_HEIGHT)) or self.height,
+                 int(self.stream.get(cv2.CAP_PROP_FRAME_WIDTH)) or self.width)
+        self.ring = FrameRing(shape, ring_capacity, ring_slack)
+        self.clock = CaptureClock()
         self.thread = None
         # initialize the variable used to indicate if the thread should
         # be stopped
@@ -91,6 +248,28 @@ class WebcamVideoStream:
         self.flag = False
         self.FPS = FPS_camera()
 
+    def set_capture_mode(self):
+        # Has to happen before the resolution is set, some backends reset it when the format changes
+        if self.capture_mode == 'bgr':
+            return
+        fourcc = 'MJPG' if self.capture_mode == 'mjpg_gray' else 'YUYV'
+        ret1 = self.stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        # hand back the raw buffer instead of a decoded BGR image
+        ret2 = self.stream.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        print(fourcc, ret1, ret2)
+
+    def store_gray(self, raw, slot):
+        # Reduce whatever the backend returned to luminance, written straight into the ring slot
+        if raw.ndim == 3 and raw.shape[2] == 3:
+            # decoded BGR, either bgr mode or a backend that ignored CONVERT_RGB
+            cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY, dst=slot)
+        elif raw.size == slot.size * 2:
+            # packed YUYV (Y0 U Y1 V ...), every other byte is luminance
+            np.copyto(slot, raw.reshape(slot.shape[0], slot.shape[1], 2)[:, :, 0])
+        else:
+            # compressed MJPG frame, decode the luminance only
+            slot[...] = cv2.imdecode(raw.reshape(-1), cv2.IMREAD_GRAYSCALE)
+
     def start(self):
         # start the thread to read frames from the video stream
 
@@ -105,9 +284,20 @@ class WebcamVideoStream:
             # if the thread indicator variable is set, stop the thread
             if self.stopped:
                 break
-            self.grabbed, self.frame = self.stream.read()
+            slot = self.ring.write_slot()
+            if slot is None:
+                # recorder is a full ring behind, grab without decoding to keep up with the camera
+                self.grabbed = self.stream.grab()
+                if self.grabbed:
+                    self.ring.drop()
+                    self.FPS.update()
+                continue
+            self.grabbed, self.frame = self.stream.read(self.frame)
             if self.grabbed:
                 # got a frame
+                timestamp = self.clock()
+                self.store_gray(self.frame, slot)
+                self.ring.commit(timestamp)
                 self.FPS.update()
             else:
                 # no frame
@@ -118,7 +308,7 @@ class WebcamVideoStream:
 
     def read(self):
         # return the frame most recently read
-        return self.frame
+        return self.ring.latest()
 
     def stop(self):
         # indicate that the thread should be stopped
@@ -126,20 +316,45 @@ class WebcamVideoStream:
         self.FPS.stop()
         print("[INFO] elasped time: {:.2f}".format(self.FPS.elapsed()))
         print("[INFO] approx. FPS: {:.2f}".format(self.FPS.fps()))
+        print("[INFO] frames captured: {}, dropped: {}".format(self.ring.written, self.ring.dropped))
         while not self.flag:
             continue
         if self.thread.is_alive():
             _async_raise(self.thread.ident, SystemExit)
 
 
+# proxy videos are recorded at 1/PROXY_SCALE of the camera resolution in each direction
+PROXY_SCALE = 2
+
+
 class Recoder():
-    def __init__(self, savePath='test.avi', show=False, vs=None):
+    '''
+    Writes the frames of <vs> into video segments. With a <savePath> the first segment starts right
+    away (one video per process). Without one, the recorder idles while the ring holds a pre-roll,
+    and open_segment()/close_segment() cut videos out of the stream (see camera_service.py).
+    '''
+    def __init__(self, savePath=None, show=False, vs=None, channel=None, writer_backend='opencv'):
         self.width = 1280
         self.height = 720
-        self.fourcc = cv2.VideoWriter_fourcc(*'MJPG')
         # self.recording_w = int(self.width//2 + self.width//5) - int(self.width//2 - self.width//5.5)
         # self.recording_h = int(self.height) - int(self.height//2 - self.height//5.5)
-        self.writer = cv2.VideoWriter(savePath, self.fourcc, 120.0, (1280, 720), False)
+        # see video_writers.py for the available backends and a benchmark to pick one
+        self.writer_backend = writer_backend
+        self.writer = None
+        self.proxy_frame = None
+        # The AVI is written at a nominal 120 fps, the sidecar records when each frame was really captured
+        self.timestamps = None
+        self.segment_lock = Lock()
+        self.segment_active = False
+        self.segment_path = None
+        self.segment_end = None    # ring index the closing segment ends at
+        self.segment_frames = 0
+        self.segment_first_timestamp = None
+        self.segment_last_timestamp = None
+        # set by the recording thread once the video file is closed, see wait_closed()
+        self.segment_closed = Event()
+        self.segment_closed.set()
+        self.segment_summary = None
         self.stopped = False
         self.FPS = FPS_camera()
         self.vs = vs
@@ -147,37 +362,113 @@ class Recoder():
         self.show = show
         self.flag = False
         self.process = None
+        # Every recorded frame is published here so main.py can grab it for the pellet detector
+        self.channel = channel
 
         #  Socket to talk to server
         # print("Connecting to hello world server…")
         # self.socket = context.socket(zmq.REQ)
         # self.socket.connect("tcp://127.0.0.1:5555")
 
+        if savePath is not None:
+            self.open_segment(savePath)
+        else:
+            self.vs.ring.stop_consuming()
+
+    def open_segment(self, path, since=None, show=None, mode='full'):
+        '''
+        Start writing a new video to <path>, beginning with the buffered frames captured at or
+        after <since> (time.time() clock, defaults to now).
+        :param show: show the frames in a window instead of recording them (TEST tag sessions)
+        :param mode: 'full' resolution video, low resolution 'proxy' video, or 'none' (frames are only
+                     published to the frame channel), see retention.py
+        '''
+        with self.segment_lock:
+            # the recording thread may still be writing the previous segment's last frames
+            if self.segment_active:
+                raise RuntimeError("%s is still being recorded" % self.segment_path)
+            if show is not None:
+                self.show = show
+            self.writer = None
+            self.proxy_frame = None
+            if mode == 'full':
+                self.writer = make_writer(self.writer_backend, path, 120.0, (self.width, self.height))
+            elif mode == 'proxy':
+                size = (self.width // PROXY_SCALE, self.height // PROXY_SCALE)
+                self.writer = make_writer(self.writer_backend, path, 120.0, size)
+                self.proxy_frame = np.empty((size[1], size[0]), dtype=np.uint8)
+            if self.writer is not None and not self.show:
+                self.timestamps = FrameTimestampWriter(timestamp_path(path))
+            self.segment_path = path
+            self.segment_frames = 0
+            self.segment_first_timestamp = None
+            self.segment_last_timestamp = None
+            self.segment_end = None
+            self.segment_summary = None
+            self.segment_closed.clear()
+            self.segment_active = True
+            self.vs.ring.start_consuming(time.time() if since is None else since)
+
+    def end_segment(self):
+        # End the current video at the newest captured frame. The recording thread writes out
+        # what is left and then closes the file, wait_closed() tells when that has happened.
+        if self.segment_active:
+            self.segment_end = self.vs.ring.written
+
+    def wait_closed(self, timeout=None):
+        '''
+        Block until the current video file is closed.
+        :return: dict with the path, frames, bytes and duration (seconds between the first and the
+                 last frame) of the video, or None if it wasn't closed within <timeout> seconds
+        '''
+        if not self.segment_closed.wait(timeout):
+            return None
+        return self.segment_summary
+
+    def close_segment(self, timeout=None):
+        self.end_segment()
+        return self.wait_closed(timeout)
+
+    def finish_segment(self):
+        # called from the recording thread once the last frame of the segment is written
+        with self.segment_lock:
+            n_bytes = 0
+            if self.writer is not None:
+                self.writer.release()
+                n_bytes = self.writer.bytes_written()
+            if self.timestamps is not None:
+                self.timestamps.close()
+            self.timestamps = None
+            if self.show:
+                cv2.destroyAllWindows()
+            duration = 0.
+            if self.segment_frames > 1:
+                duration = float(self.segment_last_timestamp - self.segment_first_timestamp)
+            self.segment_summary = {'path': self.segment_path, 'frames': self.segment_frames,
+                                    'bytes': n_bytes, 'duration': duration}
+            self.segment_active = False
+            self.vs.ring.stop_consuming()
+            self.segment_closed.set()
+
     def recording(self):
         self.FPS = self.FPS.start()
         time_str = str(time.time())
         start_time = datetime.datetime.now()
-        global DETECT_FLAG
 
         h = 720
         w = 1280
 
-        prevTime = 0
-
         while True:
-            time_iter_start = datetime.datetime.now()
-            if self.stopped:
+            # keep going after stop until every frame of the segment has been written
+            if self.segment_active and self.segment_end is not None and self.vs.ring.consumed >= self.segment_end:
+                self.finish_segment()
+            if self.stopped and not self.segment_active:
                 break
 
-            curTime = time.time() #
-            sec = curTime - prevTime #
-            prevTime = curTime #
-
-            fps = 1/(sec) #
-
-            msg = "FPS : %0.1f" % fps #
-
-            frame = self.vs.read()
+            item = self.vs.ring.get(timeout=0.1)
+            if item is None:
+                continue
+            gray, timestamp, dropped = item
 
             # pixel coords for cropping frame
             # note: you can comment this block of code out to record the entire fov of the lenses
@@ -187,12 +478,23 @@ class Recoder():
 
             # cv2.putText(frame, msg, (50, 80), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255)) #  		
 
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            if not self.show:
-                self.writer.write(gray)
-            if DETECT_FLAG:
-                cv2.imwrite("detection_frame.jpg", gray)
-                DETECT_FLAG = False
+            # frames arrive already converted to grayscale by the capture thread
+            # open_segment and finish_segment swap the writer under the same lock
+            with self.segment_lock:
+                if self.writer is not None and not self.show:
+                    if self.proxy_frame is not None:
+                        cv2.resize(gray, (self.proxy_frame.shape[1], self.proxy_frame.shape[0]),
+                                   dst=self.proxy_frame, interpolation=cv2.INTER_AREA)
+                        self.writer.write(self.proxy_frame)
+                    else:
+                        self.writer.write(gray)
+                    self.timestamps.append(timestamp, dropped)
+                self.segment_frames += 1
+                if self.segment_first_timestamp is None:
+                    self.segment_first_timestamp = timestamp
+                self.segment_last_timestamp = timestamp
+            if self.channel is not None:
+                self.channel.publish(gray, timestamp)
             self.FPS.update()
 
             if self.show:
@@ -200,12 +502,9 @@ class Recoder():
                 if cv2.waitKey(1) & 0xFF == ord('q'):
                     cv2.destroyAllWindows()
                     break
-                
-            time_iter_end = datetime.datetime.now()
-            iteration = float((time_iter_end - time_iter_start).microseconds) * 1e-6
-            time.sleep(max((1.0 / 150. - iteration), 0))
 
-        self.writer.release()
+        if self.segment_active:
+            self.finish_segment()
         self.vs.stream.release()
         cv2.waitKey(1)
         cv2.destroyAllWindows()
@@ -223,6 +522,7 @@ class Recoder():
         self.FPS.stop()
         print("[INFO] elasped time: {:.2f}".format(self.FPS.elapsed()))
         print("[INFO] approx. FPS: {:.2f}".format(self.FPS.fps()))
+        self.close_segment()
         self.stopped = True
 
         while not self.flag:
@@ -245,19 +545,23 @@ def _async_raise(tid, exctype):
         ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(tid), None)
         raise SystemError("PyThreadState_SetAsyncExc failed")
 
-def record_main(camera_src, video_path, show=False):
+def record_main(camera_src, video_path, show=False, channel_name=None, capture_mode='bgr', writer_backend='opencv'):
     print("[INFO] sampling THREADED frames from webcam...")
-    vs = WebcamVideoStream(src=camera_src).start()
-    r = Recoder(savePath=video_path, vs=vs, show=show).start()
+    channel = None
+    vs = WebcamVideoStream(src=camera_src, capture_mode=capture_mode).start()
+    if channel_name:
+        # refuses a channel made for another frame size instead of failing on the first publish
+        channel = SharedFrameChannel(channel_name, shape=vs.ring.frames.shape[1:])
+    r = Recoder(savePath=video_path, vs=vs, show=show, channel=channel, writer_backend=writer_backend).start()
     while True:
         signal = input()
         if signal == "stop":
             vs.stop()
             r.stop()
             break
-        else:
-            global DETECT_FLAG
-            DETECT_FLAG = True
+    if channel is not None:
+        channel.close()
+
 
 if __name__ == '__main__':
     DEBUG = False
@@ -267,14 +571,19 @@ if __name__ == '__main__':
         parser.add_argument('--c', help='an integer for the camer index', dest='camera_index')
         parser.add_argument('--p', help='a string', dest='video_path')
         parser.add_argument('--t', help='test', dest='test', default='False')
+        parser.add_argument('--s', help='name of the shared frame channel created by main.py', dest='channel_name', default=None)
+        parser.add_argument('--m', help='capture mode: ' + ', '.join(CAPTURE_MODES), dest='capture_mode', default='bgr')
+        parser.add_argument('--w', help='video writer backend (see video_writers.py)', dest='writer_backend', default='opencv')
         args = parser.parse_args()
         camera_index = args.camera_index
         video_path = args.video_path
         test = args.test
         if test == "True":
-            record_main(int(camera_index), video_path, show=True)
+            record_main(int(camera_index), video_path, show=True, channel_name=args.channel_name,
+                        capture_mode=args.capture_mode, writer_backend=args.writer_backend)
         else:
-            record_main(int(camera_index), video_path, show=False)
+            record_main(int(camera_index), video_path, show=False, channel_name=args.channel_name,
+                        capture_mode=args.capture_mode, writer_backend=args.writer_backend)
 
 
     else:
@@ -0,0 +1,156 @@
+"""
+    Binary event log, one file per session, next to the session history in the animal's Logs folder.
+
+    Every event is a fixed size record:
+        t_ns    int64    main.py's time.perf_counter() in nanoseconds. Capture times from the camera service
+                         (time.time() clock, see frame_channel.CaptureClock) are converted to this clock
+                         before they are logged; events line up with the video frames of the timestamp
+                         sidecar (FrameTimestampWriter) through the wall_time column of load_events
+        kind    uint16   one of EVENT_KINDS
+        value   float64  number that goes with the event (trial number, detector score, frame count, state...)
+        text    14 bytes short text that goes with the event (serial message, command)
+
+    The file starts with a 32 byte header: magic, the wall clock time and the perf_counter time at which the
+    log was opened (to turn t_ns into dates), and the session number. The log is append only and written in
+    blocks; a record cut short by a crash is ignored by the reader.
+
+    Reading a batch of sessions:
+        columns = load_events(glob.glob('AnimalProfiles/*/Logs/*.events'))
+        df = load_events_dataframe(paths)
+"""
+import os
+import struct
+import time
+from threading import Lock
+
+import numpy as np
+
+EVENT_MAGIC = b'HASRAEV1'
+EVENT_HEADER = struct.Struct('<8sdqq')
+EVENT_DTYPE = np.dtype([('t_ns', '<i8'), ('kind', '<u2'), ('value', '<f8'), ('text', 'S14')])
+
+SESSION_START = 1
+SESSION_END = 2
+ARM_RAISE = 3
+DETECTION = 4
+SERIAL_TX = 5
+SERIAL_RX = 6
+CAMERA_FRAMES = 7
+CAMERA_DROPPED = 8
+STATE_CHANGE = 9
+PELLET_GONE = 10
+EVENT_KINDS = {
+    SESSION_START: 'session_start',
+    SESSION_END: 'session_end',
+    ARM_RAISE: 'arm_raise',
+    DETECTION: 'detection',
+    SERIAL_TX: 'serial_tx',
+    SERIAL_RX: 'serial_rx',
+    CAMERA_FRAMES: 'camera_frames',
+    CAMERA_DROPPED: 'camera_dropped',
+    STATE_CHANGE: 'state_change',
+    PELLET_GONE: 'pellet_gone',
+}
+
+
+def now_ns():
+    return int(time.perf_counter() * 1e9)
+
+
+class EventLog(object):
+    '''
+    :param path: file to append the events to, created with a header if it doesn't exist
+    :param session: session number written into the header
+    :param block: number of events buffered in memory before they are written out
+    '''
+    def __init__(self, path, session=0, block=256):
+        self.path = path
+        self.buffer = np.zeros(block, dtype=EVENT_DTYPE)
+        self.count = 0
+        # events come from the session loop and from the Arduino client's reader thread
+        self.lock = Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) < EVENT_HEADER.size
+        self.file = open(path, 'ab')
+        if new:
+            self.file.write(EVENT_HEADER.pack(EVENT_MAGIC, time.time(), now_ns(), session))
+            self.file.flush()
+
+    def log(self, kind, value=0., text=b'', t_ns=None):
+        if isinstance(text, str):
+            text = text.encode('utf-8', 'replace')
+        with self.lock:
+            if self.file.closed:
+                return
+            record = self.buffer[self.count]
+            record['t_ns'] = now_ns() if t_ns is None else t_ns
+            record['kind'] = kind
+            record['value'] = value
+            record['text'] = text[:EVENT_DTYPE['text'].itemsize]
+            self.count += 1
+            if self.count == len(self.buffer):
+                self.write_buffer()
+
+    def write_buffer(self):
+        if self.count:
+            self.file.write(self.buffer[:self.count].tobytes())
+            self.file.flush()
+            self.count = 0
+
+    def flush(self):
+        with self.lock:
+            self.write_buffer()
+
+    def close(self):
+        with self.lock:
+            self.write_buffer()
+            self.file.close()
+
+
+def read_events(path):
+    '''
+    :return: (header dict, structured array of EVENT_DTYPE records)
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, wall_time, start_ns, session = EVENT_HEADER.unpack_from(data, 0)
+    assert magic == EVENT_MAGIC, "%s is not an event log" % path
+    n = (len(data) - EVENT_HEADER.size) // EVENT_DTYPE.itemsize
+    events = np.frombuffer(data, dtype=EVENT_DTYPE, count=n, offset=EVENT_HEADER.size)
+    return {'path': path, 'wall_time': wall_time, 'start_ns': start_ns, 'session': session}, events
+
+
+def load_events(paths):
+    '''
+    Load the events of many sessions into one set of columns.
+    :return: dict of numpy arrays: session (index into <paths>), t_ns, t (seconds since the log was opened),
+             wall_time (unix time), kind, value, text
+    '''
+    columns = {'session': [], 't_ns': [], 't': [], 'wall_time': [], 'kind': [], 'value': [], 'text': []}
+    for i, path in enumerate(paths):
+        header, events = read_events(path)
+        t = (events['t_ns'] - header['start_ns']) / 1e9
+        columns['session'].append(np.full(len(events), i, dtype=np.int32))
+        columns['t_ns'].append(events['t_ns'])
+        columns['t'].append(t)
+        columns['wall_time'].append(header['wall_time'] + t)
+        columns['kind'].append(events['kind'])
+        columns['value'].append(events['value'])
+        columns['text'].append(events['text'])
+    if not paths:
+        dtypes = {'session': np.int32, 't': np.float64, 'wall_time': np.float64}
+        return {name: np.zeros(0, dtype=dtypes.get(name) or EVENT_DTYPE[name]) for name in columns}
+    return {name: np.concatenate(values) for name, values in columns.items()}
+
+
+def load_events_dataframe(paths):
+    '''
+    load_events() as a pandas DataFrame, with the event kinds as a categorical column and the session
+    file path as a column.
+    '''
+    import pandas as pd
+    columns = load_events(paths)
+    df = pd.DataFrame(columns)
+    df['kind'] = pd.Categorical(df['kind'].map(EVENT_KINDS))
+    df['text'] = df['text'].str.decode('utf-8', 'replace')
+    df['path'] = pd.Categorical.from_codes(columns['session'], categories=list(paths)) if len(paths) else []
+    return df
@@ -0,0 +1,176 @@
+"""
+    In-memory frame channel between the recording process (driver_for_a_better_camera.py)
+    and the session controller (main.py).
+
+    The recorder publishes every grayscale frame it writes into a small ring of slots that
+    lives in named shared memory. The session controller attaches to the same memory and can
+    grab the latest frame at any time without touching the disk or decoding a JPEG.
+
+    Layout of the shared block:
+        header: magic, latest sequence number, slot count, height, width, channels
+        slots:  [sequence, timestamp, frame bytes] * slot count
+
+    Every slot carries its own sequence number which the writer sets to 0 while it is copying
+    into the slot, so a reader that raced the writer can notice and retry (a simple seqlock).
+
+    Frame timestamps are capture times on the time.time() clock (see CaptureClock): time.perf_counter()
+    has no common zero point between processes on Windows before Python 3.10, so its values can't be
+    compared across the camera service and main.py.
+"""
+import mmap
+import os
+import platform
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+_MAGIC = 0x4846434820524148  # "HAR HCFH"
+_HEADER = struct.Struct('<QQIIII')
+_SLOT_HEADER = struct.Struct('<Qd')
+
+
+class CaptureClock(object):
+    '''
+    Capture times any process can compare with its own time.time(). time.time() only ticks every ~16 ms
+    on Windows, so the clock runs on time.perf_counter() and is moved back onto time.time() whenever the
+    two drift more than <tolerance> seconds apart. It never runs backwards.
+    '''
+    def __init__(self, tolerance=0.02):
+        self.tolerance = tolerance
+        self.offset = time.time() - time.perf_counter()
+        self.last = 0.
+
+    def __call__(self):
+        now = time.perf_counter() + self.offset
+        wall = time.time()
+        if abs(wall - now) > self.tolerance:
+            self.offset += wall - now
+            now = wall
+        self.last = max(now, self.last)
+        return self.last
+
+
+def capture_to_perf_counter(timestamp):
+    # this process's time.perf_counter() value at capture time <timestamp>
+    return timestamp - time.time() + time.perf_counter()
+
+
+def perf_counter_to_capture(t):
+    # capture clock time of this process's time.perf_counter() value <t>
+    return t - time.perf_counter() + time.time()
+
+
+def _block_size(shape, slots):
+    return _HEADER.size + slots * (_SLOT_HEADER.size + int(np.prod(shape)))
+
+
+def _open_block(name, size, create):
+    # Windows: anonymous mapping backed by the page file, shared through its tag name.
+    # Anywhere else: a file in /dev/shm (tmpfs) so the OS never writes the frames out to disk.
+    if platform.system() == 'Windows':
+        return mmap.mmap(-1, size, tagname=name), None
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    path = os.path.join(shm_dir, name)
+    if create:
+        with open(path, 'wb') as f:
+            f.truncate(size)
+    with open(path, 'r+b') as f:
+        return mmap.mmap(f.fileno(), size), path
+
+
+class SharedFrameChannel(object):
+    '''
+    One writer (the recorder) and any number of readers (the session controller).
+    The side that outlives the other should create the channel, i.e. the camera service creates it
+    with the camera's frame shape and main.py attaches to it by name.
+    :param shape: frame shape, (height, width) or (height, width, channels). Needed to create the channel;
+                  attaching takes the shape and slot count from the channel's header and, if <shape> is
+                  given, refuses a channel holding frames of another shape.
+    '''
+    def __init__(self, name='hasra_frames', shape=None, slots=4, create=False):
+        self.name = name
+        if not create:
+            header, _ = _open_block(name, _HEADER.size, False)
+            magic, _, slots, height, width, channels = _HEADER.unpack_from(header, 0)
+            header.close()
+            if magic != _MAGIC:
+                raise IOError("No frame channel named %s" % name)
+            found = (height, width) if channels == 1 else (height, width, channels)
+            if shape is not None and tuple(shape) != found:
+                raise ValueError("Frame channel %s holds %s frames, not %s" % (name, found, tuple(shape)))
+            shape = found
+        assert shape is not None, "Creating a frame channel needs the frame shape"
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.frame_size = int(np.prod(self.shape))
+        self.slot_size = _SLOT_HEADER.size + self.frame_size
+        self.buf, self.path = _open_block(name, _block_size(self.shape, slots), create)
+        channels = self.shape[2] if len(self.shape) == 3 else 1
+        if create:
+            _HEADER.pack_into(self.buf, 0, _MAGIC, 0, slots, self.shape[0], self.shape[1], channels)
+            for i in range(slots):
+                _SLOT_HEADER.pack_into(self.buf, self._slot_offset(i), 0, 0.)
+        self._views = [np.ndarray(self.shape, dtype=np.uint8, buffer=self.buf,
+                                  offset=self._slot_offset(i) + _SLOT_HEADER.size)
+                       for i in range(slots)]
+
+    def _slot_offset(self, index):
+        return _HEADER.size + index * self.slot_size
+
+    def sequence(self):
+        # sequence number of the latest complete frame, 0 if nothing has been published yet
+        return _HEADER.unpack_from(self.buf, 0)[1]
+
+    def publish(self, frame, timestamp=None):
+        '''
+        Copy <frame> into the next slot and make it the latest frame.
+        :param frame: uint8 array with the channel's shape
+        :param timestamp: capture time of the frame (time.time() clock), now by default
+        :return: the sequence number of the published frame
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        seq = self.sequence() + 1
+        index = seq % self.slots
+        offset = self._slot_offset(index)
+        # mark the slot as being written, copy, then stamp it with its sequence number
+        _SLOT_HEADER.pack_into(self.buf, offset, 0, timestamp)
+        self._views[index][...] = frame
+        _SLOT_HEADER.pack_into(self.buf, offset, seq, timestamp)
+        struct.pack_into('<Q', self.buf, 8, seq)
+        return seq
+
+    def latest(self, newer_than=0, timeout=1.0, out=None):
+        '''
+        Return (sequence, timestamp, frame) for the most recent frame with a sequence number
+        above <newer_than>. Returns None if no such frame shows up within <timeout> seconds.
+        :param out: optional preallocated array to copy the frame into
+        '''
+        deadline = time.perf_counter() + timeout
+        while True:
+            seq = self.sequence()
+            if seq > newer_than:
+                index = seq % self.slots
+                offset = self._slot_offset(index)
+                if _SLOT_HEADER.unpack_from(self.buf, offset)[0] == seq:
+                    if out is None:
+                        frame = self._views[index].copy()
+                    else:
+                        np.copyto(out, self._views[index])
+                        frame = out
+                    slot_seq, timestamp = _SLOT_HEADER.unpack_from(self.buf, offset)
+                    # if the writer lapped us while copying, try again with the newer frame
+                    if slot_seq == seq:
+                        return seq, timestamp, frame
+                continue
+            if time.perf_counter() > deadline:
+                return None
+            time.sleep(0.001)
+
+    def close(self, unlink=False):
+        self._views = []
+        self.buf.close()
+        if unlink and self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
@@ -5,6 +5,7 @@
 """
 
 import os
+from profile_store import ProfileStore
 
 def gen_profile(mouseName, cageNumber):
 
@@ -32,17 +33,10 @@ def gen_profile(mouseName, cageNumber):
     os.mkdir(".."+os.sep+".."+os.sep+"AnimalProfiles"+os.sep+str(mouseName) +os.sep+"Videos")
     os.mkdir(".."+os.sep+".."+os.sep+"AnimalProfiles"+os.sep+str(mouseName) +os.sep+"Temp")
 
-    saveFile = open(".."+os.sep+".."+os.sep+"AnimalProfiles"+os.sep+ str(mouseName) + os.sep + str(mouseName) + "_save.txt", "w+")
-    saveFile.write(str(RFID) + "\n")
-    saveFile.write(str(mouseName) + "\n")
-    saveFile.write(str(mouseNumber) + "\n")
-    saveFile.write(str(cageNumber) + "\n")
-    saveFile.write(str(difficulty) + "\n")
-    saveFile.write(str(difficulty) + "\n")
-    saveFile.write(str(difficulty) + "\n")
-    saveFile.write(str(paw) + "\n")
-    saveFile.write(str(sessionNumber) + "\n")
-    saveFile.write(str(profileDirectory) + "\n")
+    ProfileStore(".."+os.sep+".."+os.sep+"AnimalProfiles").create({
+        'ID': RFID, 'name': mouseName, 'mouseNumber': mouseNumber, 'cageNumber': cageNumber,
+        'difficulty_dist_mm1': difficulty, 'difficulty_dist_mm2': difficulty, 'difficulty_dist_mm3': difficulty,
+        'dominant_hand': paw, 'session_count': sessionNumber, 'animal_profile_directory': profileDirectory})
     logFile = open(".."+os.sep+".."+os.sep+"AnimalProfiles"+os.sep+ str(mouseName)+os.sep+"Logs"+os.sep+ str(mouseName) + "_session_history.csv", "w+")
     print("Profile created for " + str(mouseName) + "!")
 
@@ -53,8 +47,8 @@ def main():
         os.makedirs(animal_profiles_dir)
 
     cageNumber = input('Enter cage number: ')
-    print('Please remember to add Mouse RFID tag numbers, right now theyre all set to 0)
-    print('This can be done by opening up MOUSE_save.txt for each MOUSE and editing the first line')
+    print('Please remember to add Mouse RFID tag numbers, right now theyre all set to 0')
+    print('This can be done by opening up MOUSE_profile.json for each MOUSE and editing the "ID" field')
 
     for i in range(1,6):
         gen_profile("MOUSE" + str(i), cageNumber)
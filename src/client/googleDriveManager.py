@@ -12,6 +12,7 @@ import os
 import psutil
 import sys
 import ctypes
+from profile_store import ProfileStore
 
 def copyLargeFile(src, dest, buffer_size=int(8*1e6)):
     '''
@@ -119,7 +120,8 @@ def googleDriveManager(interval=20, min_interval=10, cage_id=1, mice_n=4, gdrive
                     logs_root_dir = os.path.join(local_profileDir, 'MOUSE' + str(i), 'Logs')
                     video_list = os.listdir(video_root_dir)
                     for file_item in video_list:
-                        if file_item.endswith('.avi') and 'temp' not in os.path.basename(file_item):
+                        # videos (.avi, or .npy raw frame dumps) and their frame timestamp sidecars (<video>.ts.npy)
+                        if (file_item.endswith('.avi') or file_item.endswith('.npy')) and 'temp' not in os.path.basename(file_item):
                             full_path = os.path.join(video_root_dir, file_item)
                             # if os.path.getsize(full_path) < 18*1e6:
                             #     os.remove(full_path)
@@ -166,7 +168,7 @@ def googleDriveManager(interval=20, min_interval=10, cage_id=1, mice_n=4, gdrive
                             if size_origin == size_target:
                                 upload_success = True
                                 print("\n\nFile uploaded as: %s successfully! \n" % target_dir)
-                                if origin_dir.endswith('.avi'):
+                                if origin_dir.endswith('.avi') or origin_dir.endswith('.npy'):
                                     os.remove(origin_dir)
                                     print("Original file:%s deleted." % origin_dir)
                                 uploading_list.remove(item)
@@ -209,12 +211,7 @@ if __name__ == '__main__':
     # if cage_index.isdigit():
     #    cage_index = int(cage_index)
 
-    with open(".." + os.sep + ".." + os.sep + "AnimalProfiles" + os.sep + "MOUSE1" + os.sep + "MOUSE1_save.txt") as f:
-        tmp = ""
-        for _ in range(4):
-            tmp = f.readline()
-        cage_index = tmp
-    cage_index = int(cage_index)
+    cage_index = int(ProfileStore(".." + os.sep + ".." + os.sep + "AnimalProfiles").load("MOUSE1")['cageNumber'])
     print(type(cage_index), cage_index)
 
     # if cage_index.isdigit():
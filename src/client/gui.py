@@ -6,6 +6,7 @@
 
 from tkinter import *
 import os
+from profile_store import ProfileStore
 
 # This is the GUI for configuring AnimalProfiles. It reads profiles from the ~/HomeCageSinglePellet/AnimalProfiles/ directory.
 # It expects to find 5 profiles there and will not work with any other number. Profiles should be named as follows: 
@@ -21,7 +22,8 @@ import os
 #
 #
 # Most of the buttons are attached to a function that simply reads and writes to a profileState. They will also update text boxes
-# when appropriate. It's mostly clear just by reading it.
+# when appropriate. It's mostly clear just by reading it. Profiles are read and written through a ProfileStore (profile_store.py),
+# which only rewrites the fields that changed, so the GUI and a running session can save the same profile safely.
 #
 # TODO: glob file paths
 
@@ -34,8 +36,8 @@ class GUI:
 
 		self.master = master
 		self.animalProfilePath = animalProfilePath
+		self.profileStore = ProfileStore(animalProfilePath)
 		self.profileNames = []
-		self.profileSaveFilePaths = []
 		self.profileStates = []
 		self.currentMouse = -1
 
@@ -73,9 +75,9 @@ class GUI:
 
 		for mouse in range(1, 7):
 			profileIndex = self.find_profile_state_index(mouse)
-			self.dists1[mouse - 1] = self.profileStates[profileIndex][4]
-			self.dists2[mouse - 1] = self.profileStates[profileIndex][5]
-			self.dists3[mouse - 1] = self.profileStates[profileIndex][6]
+			self.dists1[mouse - 1] = self.profileStates[profileIndex]['difficulty_dist_mm1']
+			self.dists2[mouse - 1] = self.profileStates[profileIndex]['difficulty_dist_mm2']
+			self.dists3[mouse - 1] = self.profileStates[profileIndex]['difficulty_dist_mm3']
 
 		for i in range(6):
 			temp_label = Label(frame2, text="trial limitation")
@@ -167,47 +169,20 @@ class GUI:
 
 	def load_animal_profiles(self):
 
-		self.profileNames = []
-		self.profileStates = []
-		self.profileSaveFilePaths = []
-
-		# Get list of profile folders
-		self.profileNames = os.listdir(self.animalProfilePath)
-
-
-		for profile in self.profileNames:
-
-			# Build save file path and save in list
-			loadFile = self.animalProfilePath + os.sep + profile + os.sep + profile + "_save.txt"
-			# Open the save file
-			try:
-				load = open(loadFile, 'r')
-			except IOError:
-				print ("Could not open AnimalProfile save file!")
+		# Each profileState is a profile store record, see PROFILE_SCHEMA in profile_store.py.
+		# poll() only parses the profile files that changed on disk since the last call, everything else
+		# comes from its cache, so this is cheap enough to run on every spinbox click.
+		if not self.profileStore.poll() and self.profileNames:
+			return
+		self.profileStates = [dict(record) for _, (_, record) in sorted(self.profileStore.cache.items())]
+		self.profileNames = [profileState['name'] for profileState in self.profileStates]
 
-			# Read all lines from save file and strip them
-			with load:
-				profileState = load.readlines()
+	# Only the given fields are written, the rest of the profile is left as it is on disk
+	def save_animal_profile(self, profileIndex, fields):
 
-			self.profileStates.append([x.strip() for x in profileState])
-
-
-			self.profileSaveFilePaths.append(loadFile)
-
-	# Does len(profileIndex) always == 10? or will this throw sometimes?
-	def save_animal_profile(self, profileIndex):
-
-		with open(self.profileSaveFilePaths[profileIndex], 'w') as save:
-			save.write(str(self.profileStates[profileIndex][0]) + "\n")
-			save.write(str(self.profileStates[profileIndex][1]) + "\n")
-			save.write(str(self.profileStates[profileIndex][2]) + "\n")
-			save.write(str(self.profileStates[profileIndex][3]) + "\n")
-			save.write(str(self.profileStates[profileIndex][4]) + "\n")
-			save.write(str(self.profileStates[profileIndex][5]) + "\n")
-			save.write(str(self.profileStates[profileIndex][6]) + "\n")
-			save.write(str(self.profileStates[profileIndex][7]) + "\n")
-			save.write(str(self.profileStates[profileIndex][8]) + "\n")
-			save.write(str(self.profileStates[profileIndex][9]) + "\n")
+		profileState = self.profileStates[profileIndex]
+		changes = dict((field, profileState[field]) for field in fields)
+		self.profileStates[profileIndex] = self.profileStore.update(profileState['name'], changes)
 
 
 	# Since the profiles might be loaded into <profileStates> in an arbitrary order,
@@ -219,20 +194,25 @@ class GUI:
 	def find_profile_state_index(self, mouseNumber):
 
 		for x in range(0,len(self.profileStates)):
-			if mouseNumber == int(self.profileStates[x][2]):
+			if str(mouseNumber) == self.profileStates[x]['mouseNumber']:
 
 				return x
 
 		return -1
 
+	# Called on every spinbox click, so only the profiles whose distances actually changed get written
 	def on_update(self):
 		self.load_animal_profiles()
 		for i in range(1, 7):
 			profileIndex = self.find_profile_state_index(i)
-			self.profileStates[profileIndex][4] = self.dists1[i - 1]
-			self.profileStates[profileIndex][5] = self.dists2[i - 1]
-			self.profileStates[profileIndex][6] = self.dists3[i - 1]
-			self.save_animal_profile(profileIndex)
+			if profileIndex == -1:
+				continue
+			profileState = self.profileStates[profileIndex]
+			dists = (int(self.dists1[i - 1]), int(self.dists2[i - 1]), int(self.dists3[i - 1]))
+			if dists == (profileState['difficulty_dist_mm1'], profileState['difficulty_dist_mm2'], profileState['difficulty_dist_mm3']):
+				continue
+			profileState['difficulty_dist_mm1'], profileState['difficulty_dist_mm2'], profileState['difficulty_dist_mm3'] = dists
+			self.save_animal_profile(profileIndex, ['difficulty_dist_mm1', 'difficulty_dist_mm2', 'difficulty_dist_mm3'])
 
 	def update_button_onClick(self):
 
@@ -249,8 +229,8 @@ class GUI:
 
 			else:
 
-				self.profileStates[profileIndex][4] = self.scale.get()
-				self.save_animal_profile(profileIndex)
+				self.profileStates[profileIndex]['difficulty_dist_mm1'] = int(self.scale.get())
+				self.save_animal_profile(profileIndex, ['difficulty_dist_mm1'])
 
 
 	def shutdown_onClick(self):
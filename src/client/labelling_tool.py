@@ -0,0 +1,186 @@
+"""
+    Labelling tool for the pellet detector's training frames (data_utils.generate_dataset).
+
+    Every <every>th frame of each session video is shown and labelled with one key press:
+        1   the pellet moved / is gone   -> <output>/1
+        2   the pellet is idle           -> <output>/0
+        3   discard the frame
+        q   stop (Esc works too), the next run carries on where this one stopped
+
+    A background thread reads the sampled frames ahead of the one on screen, seeking straight to each
+    sampled frame instead of decoding every frame in between, so the next frame is ready by the time a key
+    is pressed. What gets saved is the detector's region of the frame (detector_input.ROI) resized to the
+    detector's input size, the same crop Detector and RuntimeDetector score at run time, so training and
+    detector_calibration.py see what the cage PC sees. Images and decisions are handed to a SessionJournal (session_journal.py) and written to disk
+    in batches on its thread. Every decision is a line in <output>/labelling.jsonl; frames already decided
+    there are skipped on the next run (a labelled frame whose image never made it to disk is shown again).
+"""
+import json
+import os
+from queue import Queue, Full
+from threading import Thread, Event
+
+import cv2
+
+from detector_input import PELLET_CAM_ROI
+from session_journal import SessionJournal
+
+MANIFEST_NAME = 'labelling.jsonl'
+# keys, as returned by cv2.waitKey
+LABEL_KEYS = {ord('1'): 1, ord('2'): 0, ord('3'): None}
+QUIT_KEYS = (ord('q'), 27)
+# the reader seeks to the next sampled frame if it is further ahead than this, and grabs its way there otherwise
+SEEK_DISTANCE = 30
+
+
+def image_name(video_file, frame_index):
+    # same names the old generate_dataset gave its images (it numbered frames from 1)
+    return os.path.basename(video_file).replace(".avi", "") + "%d.jpg" % (frame_index + 1)
+
+
+def load_manifest(output_folder):
+    '''
+    :return: set of (video name, frame index) already decided
+    '''
+    done = set()
+    path = os.path.join(output_folder, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            label = entry['label']
+            if label is not None and \
+                    not os.path.isfile(os.path.join(output_folder, str(label), image_name(entry['video'], entry['frame']))):
+                continue
+            done.add((entry['video'], entry['frame']))
+    return done
+
+
+class FramePrefetcher(object):
+    '''
+    Reads the frames to label on a background thread.
+    :param work: list of (video file, [frame indices]) in labelling order
+    :param ahead: most frames read ahead of the one being labelled
+    '''
+    def __init__(self, work, ahead=16):
+        self.work = work
+        self.queue = Queue(maxsize=ahead)
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def put(self, item):
+        # False if the tool stopped while waiting for room in the queue
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            for video_file, indices in self.work:
+                stream = cv2.VideoCapture(video_file)
+                try:
+                    if not self.read_video(stream, video_file, indices):
+                        return
+                finally:
+                    stream.release()
+        finally:
+            # always tell get() there is nothing more, even if a video couldn't be read
+            self.put(None)
+
+    def read_video(self, stream, video_file, indices):
+        # False if the tool stopped
+        position = 0
+        for index in indices:
+            if index - position > SEEK_DISTANCE:
+                stream.set(cv2.CAP_PROP_POS_FRAMES, index)
+                position = index
+            while position < index and stream.grab():
+                position += 1
+            grab, frame = stream.read()
+            position += 1
+            if not grab:
+                break
+            if not self.put((video_file, index, frame)):
+                return False
+        return True
+
+    def get(self):
+        '''
+        :return: (video file, frame index, frame), None once every frame was read
+        '''
+        return self.queue.get()
+
+
+def label_videos(input_folder, output_folder, every=60, ahead=16, roi=None):
+    '''
+    :param roi: detector_input.ROI saved of every labelled frame, the pellet cam's by default
+    '''
+    roi = roi or PELLET_CAM_ROI
+    assert os.path.isdir(input_folder) and os.path.isdir(output_folder)
+    for label in ('0', '1'):
+        if not os.path.exists(os.path.join(output_folder, label)):
+            os.mkdir(os.path.join(output_folder, label))
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    done = load_manifest(output_folder)
+
+    work = []
+    for video_file in sorted(os.path.join(input_folder, item) for item in os.listdir(input_folder)
+                             if item.endswith('.avi')):
+        stream = cv2.VideoCapture(video_file)
+        frame_count = int(stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        stream.release()
+        name = os.path.basename(video_file)
+        indices = [index for index in range(0, frame_count, every) if (name, index) not in done]
+        if indices:
+            work.append((video_file, indices))
+    total = sum(len(indices) for _, indices in work)
+    print("%d frames to label in %d videos (%d already done)" % (total, len(work), len(done)))
+
+    journal = SessionJournal(flush_interval=1.0, fsync='interval').start()
+    prefetcher = FramePrefetcher(work, ahead).start()
+    labelled = 0
+    try:
+        while True:
+            item = prefetcher.get()
+            if item is None:
+                break
+            video_file, index, frame = item
+            image = cv2.resize(roi.crop(frame), (roi.input_size, roi.input_size))
+            # the frame itself is only shown from here on, so the text goes straight onto it
+            cv2.putText(frame, "1: Move,2: Idle,3: Discard,q: Quit  (%d/%d)" % (labelled + 1, total), (40, 40),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), lineType=cv2.LINE_AA)
+            cv2.imshow('frame', frame)
+            key = cv2.waitKey(0) & 0xFF
+            while key not in LABEL_KEYS and key not in QUIT_KEYS:
+                key = cv2.waitKey(0) & 0xFF
+            if key in QUIT_KEYS:
+                break
+            label = LABEL_KEYS[key]
+            if label is not None:
+                journal.submit(cv2.imwrite, os.path.join(output_folder, str(label), image_name(video_file, index)),
+                               image)
+            journal.append(manifest_path, [json.dumps({'video': os.path.basename(video_file), 'frame': index,
+                                                       'label': label, 'roi': [roi.top, roi.left, roi.size]})])
+            labelled += 1
+    finally:
+        prefetcher.stop()
+        journal.close()
+        cv2.destroyAllWindows()
+    print("Labelled %d frames, %d left" % (labelled, total - labelled))
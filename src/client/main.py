@@ -4,24 +4,39 @@
     Organization: University of Ottawa (Silasi Lab)
 """
 
+import time
+# how long the imports below take is reported at startup
+IMPORT_START = time.perf_counter()
 import gui
 import arduinoClient
 import systemCheck
-import time
 import multiprocessing
 import serial
 import serial.tools.list_ports
-from subprocess import PIPE, Popen
+from subprocess import Popen
 import os
 import datetime
 from driver_for_a_better_camera import *
-from googleDriveManager import is_locked
+from frame_channel import SharedFrameChannel, capture_to_perf_counter, perf_counter_to_capture
+from camera_service import CameraClient
+from video_writers import WRITER_EXTENSIONS
 import numpy as np
-from detector import Detector
+from detector_worker import DetectorWorker
+from detector_input import ROI
+from pellet_tracker import PelletTracker
 import sys
-from collections import deque
-import random
 import ctypes
+import atexit
+from threading import Thread, Event
+import retention
+from session_journal import SessionJournal
+from profile_store import ProfileStore
+from profile_registry import ProfileRegistry
+from rfid_reader import RFIDReader
+from session_fsm import SessionStateMachine, SessionTimings, SESSION_STATES, DETECTING
+from event_log import EventLog, SESSION_START, SESSION_END, ARM_RAISE, DETECTION, SERIAL_TX, SERIAL_RX, \
+    CAMERA_FRAMES, CAMERA_DROPPED, STATE_CHANGE, PELLET_GONE
+print("main.py imports took %.2f s" % (time.perf_counter() - IMPORT_START))
 
 # set to True if you want to use object detection mobilenet to decide when
 #  to lower the arm
@@ -31,6 +46,32 @@ use_detector = False
 #  (only needed when use_detector == True)
 pellet_wait_time_hard_limit = 25
 
+# Model the pellet detector loads. A .h5 file is loaded with Keras (detector.py), a .tflite or .onnx file
+# exported by detector_runtime.py is loaded with the lightweight runtime instead.
+# The detector is loaded on a background thread at startup when the session mode needs it, and the first
+# session waits for it (see SessionController.wait_for_detector).
+DETECTOR_MODEL = "model/model.h5"
+# Square region of the camera frame the pellet sits in, the detector only looks at this (see detector_input.py)
+DETECTOR_ROI = ROI(top=272, left=416, size=448)
+
+# The detector worker scores up to this many frames in one forward pass
+DETECTOR_BATCH_SIZE = 4
+# Detector results for frames captured longer ago than this (seconds) are too old to decide on
+DETECTOR_MAX_RESULT_AGE = 1.0
+
+# In detector mode the arm is lowered once the moving average of the per-frame detector scores rises
+# PELLET_GONE_MARGIN of the way from the detector's calibrated threshold to 1, and the pellet counts as back
+# once it falls PELLET_BACK_MARGIN of the way to 0 (see pellet_tracker.py). PELLET_TRACKER_ALPHA is the
+# weight of the newest frame.
+PELLET_TRACKER_ALPHA = 0.3
+PELLET_GONE_MARGIN = 0.4
+PELLET_BACK_MARGIN = 0.2
+
+# Timing of the presentations within a session, see session_fsm.py
+# initial_delay is the time before the first presentation after the IR beam is broken.
+SESSION_TIMINGS = SessionTimings(initial_delay=4.0, present_timeout=5.0, detect_delay=4.0,
+                                 pellet_wait_limit=pellet_wait_time_hard_limit, idle_interval=5.0)
+
 # I recommend not setting this to True and just running the script in its
 # own cmd prompt window, the feature is available nonetheless
 run_google_drive_script = False
@@ -40,7 +81,6 @@ if run_google_drive_script:
         'python', 'googleDriveManager.py'
     ])
 
-D = Detector("model/model.h5")
 systemCheck.check_directory_structure()
 
 # Load all configuration information for running the system.
@@ -48,9 +88,52 @@ systemCheck.check_directory_structure()
 dirpath = os.getcwd()
 base_dir = dirpath.split('src'+os.sep+'client')[0]
 PROFILE_SAVE_DIRECTORY = os.path.join(base_dir, 'AnimalProfiles')
+# All profile reads and writes go through the store, see profile_store.py
+PROFILE_STORE = ProfileStore(PROFILE_SAVE_DIRECTORY)
+
+# Name of the shared memory block the camera service publishes its frames into (see frame_channel.py)
+FRAME_CHANNEL_NAME = 'hasra_frames'
+
+# How the recorder pulls frames off the camera, see CAPTURE_MODES in driver_for_a_better_camera.py.
+# 'mjpg_gray' skips the BGR decode + colour conversion but depends on the camera driver handing back raw MJPG.
+CAPTURE_MODE = 'bgr'
+
+# Which video writer the recorder uses: 'opencv' (MJPG avi), 'raw' (uncompressed .npy) or 'ffmpeg' (x264 avi).
+# Run video_writers.py on the cage PC to see which ones keep up with the camera.
+VIDEO_WRITER_BACKEND = 'opencv'
+
+# The camera service always keeps this many seconds of video in memory, so each session video
+# starts this long before the RFID read that triggered it.
+PREROLL_SECONDS = 1.0
+
+# How long a session waits for the camera service to finish writing and close the session video
+VIDEO_CLOSE_TIMEOUT = 30
+
+# Decides at the start of each session whether it gets a full video, a low resolution proxy or no video
+# at all (see retention.py). This keeps 1 in 4 sessions, like the old random draw after recording did.
+RETENTION_POLICY = retention.RetentionPolicy(sample_chance=4, keep_test_tags=True, keep_if_successful=False,
+                                             otherwise=retention.NONE)
+
+# Log files and profile save files are written by this journal's background thread, see session_journal.py
+SESSION_JOURNAL = SessionJournal(flush_interval=1.0, fsync='interval').start()
+atexit.register(SESSION_JOURNAL.close)
 
 ctypes.windll.kernel32.SetConsoleTitleW('main.py')
 
+# Build the pellet detector for <model_path>. Keras/TensorFlow are only imported here, so main.py starts
+# without them when the detector is never used.
+def load_detector(model_path, roi):
+    start = time.perf_counter()
+    if model_path.endswith('.h5'):
+        from detector import Detector
+        detector = Detector(model_path, roi=roi)
+    else:
+        from detector_runtime import RuntimeDetector
+        detector = RuntimeDetector(model_path, roi=roi)
+    print("Pellet detector %s loaded in %.2f s" % (model_path, time.perf_counter() - start))
+    return detector
+
+
 # This performs a COM port scan and reads their descriptions to find which 
 # port the arduino is in and which port the RFID tag read is in
 # these ports are needed later in the sys_init function
@@ -69,20 +152,6 @@ def get_com_ports():
 
     return ard_port, rfid_port
 
-# This function generates a list of AnimalProfiles found inside <profile_save_directory>.
-# It then reads the save.txt file for each profile found, and uses the information
-# in that file to reconstruct the AnimalProfile object. It returns all the
-# reconstructed profiles as a list of AnimalProfiles.
-# Note: This function works by assuming the directory structure of each AnimalProfile
-# is consistent and the required save.txt files are present, i.e:
-#
-# <profile_save_directory>
-#   -
-#   - ProfileName
-#       -
-#       - Logs
-#       - Videos
-#       - save.txt
 mouse1TrialLimit = None
 mouse2TrialLimit = None
 mouse3TrialLimit = None
@@ -120,47 +189,13 @@ def resetAnimalProfileTrialsToday():
         mouse4TrialsToday = 0
         mouse5TrialsToday = 0
 
-# Profile_save_directory files have to be be formatted properly to load
-# into this func. The older versions will not include a line to configure
-# the difficulty_dist_mm3 variable (height)
-def loadAnimalProfiles(profile_save_directory):
-    # Get list of profile folders
-    profile_names = os.listdir(profile_save_directory)
-    profiles = []
-    print(profile_names)
-    for profile in profile_names:
-
-        # Build save file path
-        # load_file = profile_save_directory + profile + "/" + profile + "_save.txt"
-        load_file = os.path.join(profile_save_directory , profile, profile + "_save.txt")
-        profile_state = []
-        # Open the save file
-        try:
-            load = open(load_file, 'r')
-        except IOError:
-            print("Could not open AnimalProfile save file!")
-
-        # Read all lines from save file and strip them
-        with load:
-            profile_state = load.readlines()
-        profile_state = [x.strip() for x in profile_state]
-
-        # Create AnimalProfile object using loaded data and put it in profile list
-        ID = profile_state[0]
-        name = profile_state[1]
-        mouseNumber = profile_state[2]
-        cageNumber = profile_state[3]
-        difficulty_dist_mm1 = profile_state[4]
-        difficulty_dist_mm2 = profile_state[5]
-        difficulty_dist_mm3 = profile_state[6]
-        dominant_hand = profile_state[7]
-        session_count = profile_state[8]
-        animal_profile_directory = load_file.replace(name + "_save.txt", "")
-        temp = AnimalProfile(ID, name, mouseNumber, cageNumber, difficulty_dist_mm1, difficulty_dist_mm2, difficulty_dist_mm3, dominant_hand, session_count,
-                             animal_profile_directory, False)
-        profiles.append(temp)
-
-    return profiles
+# Reconstructs a single AnimalProfile from a profile store <record> (see PROFILE_SCHEMA in profile_store.py).
+def animalProfileFromRecord(record):
+
+    animal_profile_directory = os.path.join(PROFILE_SAVE_DIRECTORY, record['name']) + os.sep
+    return AnimalProfile(record['ID'], record['name'], record['mouseNumber'], record['cageNumber'],
+                         record['difficulty_dist_mm1'], record['difficulty_dist_mm2'], record['difficulty_dist_mm3'],
+                         record['dominant_hand'], record['session_count'], animal_profile_directory, False)
 
 
 class AnimalProfile(object):
@@ -216,23 +251,18 @@ class AnimalProfile(object):
             if not os.path.isdir(self.log_save_directory):
                 os.makedirs(self.log_save_directory)
 
-    # This function writes the state of the AnimalProfile object to the
-    # AnimalProfile's save file.
-    def saveProfile(self):
-
-        save_file_path = self.animal_profile_directory + str(self.name) + "_save.txt"
+    # This function writes the state of the AnimalProfile object to the profile store, from the
+    # session journal's thread. Pass <fields> to only write those, so a save doesn't undo changes the GUI
+    # made to the other fields in the meantime.
+    def saveProfile(self, fields=None):
 
-        with open(save_file_path, 'w') as save:
-            save.write(str(self.ID) + "\n")
-            save.write(str(self.name) + "\n")
-            save.write(str(self.mouseNumber) + "\n")
-            save.write(str(self.cageNumber) + "\n")
-            save.write(str(self.difficulty_dist_mm1) + "\n")
-            save.write(str(self.difficulty_dist_mm2) + "\n")
-            save.write(str(self.difficulty_dist_mm3) + "\n")
-            save.write(str(self.dominant_hand) + "\n")
-            save.write(str(self.session_count) + "\n")
-            save.write(str(self.animal_profile_directory) + "\n")
+        state = {'ID': self.ID, 'name': self.name, 'mouseNumber': self.mouseNumber, 'cageNumber': self.cageNumber,
+                 'difficulty_dist_mm1': self.difficulty_dist_mm1, 'difficulty_dist_mm2': self.difficulty_dist_mm2,
+                 'difficulty_dist_mm3': self.difficulty_dist_mm3, 'dominant_hand': self.dominant_hand,
+                 'session_count': self.session_count, 'animal_profile_directory': self.animal_profile_directory}
+        if fields is not None:
+            state = dict((field, state[field]) for field in fields)
+        SESSION_JOURNAL.submit(PROFILE_STORE.update, self.name, state)
 
     # Generates the path where the video for the next session will be stored
     def genVideoPath(self, videoStartTimestamp):
@@ -242,39 +272,29 @@ class AnimalProfile(object):
             self.ID) + "_" + str(self.cageNumber) + "_" + str(self.session_count))
         return temp_dir
 
+    # Generates the path of the binary event log (see event_log.py) of the session starting at <sessionStartTimestamp>
+    def genEventLogPath(self, sessionStartTimestamp):
+
+        return os.path.join(PROFILE_SAVE_DIRECTORY, str(self.name), "Logs",
+                            os.path.basename(self.genVideoPath(sessionStartTimestamp)) + ".events")
+
     # This function takes all the information required for an animal's session log entry, and then formats it.
-    # Once formatted, it appends the log entry to the animal's session_history.csv file.
+    # Once formatted, the session journal appends the log entry to the animal's session_history.csv file.
     def insertSessionEntry(self, start_timestamp, end_timestamp, trial_count, successful_count=0):
 
-        # TODO: Is there a better way to create + format strings?
-        # session_history = self.log_save_directory + str(self.name) + "_session_history.csv"
         session_history = os.path.join(PROFILE_SAVE_DIRECTORY, str(self.name), 'Logs', str(self.name)+"_session_history.csv")
-        start_date = time.strftime("%d-%b-%Y", time.localtime(start_timestamp))
-        start_time = time.strftime("%H:%M:%S", time.localtime(start_timestamp))
-        end_date = time.strftime("%d-%b-%Y", time.localtime(end_timestamp))
-        end_time = time.strftime("%H:%M:%S", time.localtime(end_timestamp))
-        csv_entry = str(self.session_count) + "," + str(self.name) + "," + str(self.ID) + "," + str(
-            trial_count) + "," + str(successful_count) + "," + str(self.difficulty_dist_mm1) + "," + str(self.difficulty_dist_mm2) + "," + str(self.difficulty_dist_mm3) + "," + str(
-            self.dominant_hand) + "," + start_date + "," + start_time + "," + end_date + "," + end_time + "\n"
-        if not os.path.exists(session_history):
-            with open(session_history, "w") as log:
-                log.write(csv_entry)
-        else:
-            with open(session_history, "a") as log:
-                log.write(csv_entry)
+        start = time.localtime(start_timestamp)
+        end = time.localtime(end_timestamp)
+        csv_entry = ",".join([str(self.session_count), str(self.name), str(self.ID), str(trial_count),
+                              str(successful_count), str(self.difficulty_dist_mm1), str(self.difficulty_dist_mm2),
+                              str(self.difficulty_dist_mm3), str(self.dominant_hand),
+                              time.strftime("%d-%b-%Y,%H:%M:%S", start), time.strftime("%d-%b-%Y,%H:%M:%S", end)])
+        SESSION_JOURNAL.append(session_history, [csv_entry])
 
     def insertDisplay(self, time_stamp_list):
         csv_file = os.path.join(PROFILE_SAVE_DIRECTORY, str(self.name), 'Logs', str(self.name)+"_display_history.txt")
-        if not os.path.exists(csv_file):
-            with open(csv_file, 'w') as f:
-                for time_stamp in time_stamp_list:
-                    time_string = time_stamp.strftime("%Y/%m/%d,%H:%M:%S")
-                    f.write(time_string + "\n")
-        else:
-            with open(csv_file, 'a') as f:
-                for time_stamp in time_stamp_list:
-                    time_string = time_stamp.strftime("%Y/%m/%d,%H:%M:%S")
-                    f.write(time_string + "\n")
+        if time_stamp_list:
+            SESSION_JOURNAL.append(csv_file, [time_stamp.strftime("%Y/%m/%d,%H:%M:%S") for time_stamp in time_stamp_list])
 
 class SessionController(object):
     """
@@ -285,31 +305,88 @@ class SessionController(object):
                 A SessionController has the following properties:
 
 		Attributes:
-			profile_list: A list containing all animal profiles.
+			profile_registry: All animal profiles, indexed by RFID (see profile_registry.py).
 			arduino_client: An object that wraps a serial interface for talking to the Arduino server.
+			frame_channel: Shared memory the camera service publishes its frames into. Used by the pellet detector.
+			camera: Client for the camera service (camera_service.py). The service keeps the camera open
+			        across sessions (and across restarts of main.py), each session just tells it to start and stop a video.
+			detector_worker: Scores the frames coming through <frame_channel> with the pellet detector on its own
+			        thread (detector_worker.py). Sessions read its latest result. None until the detector is loaded,
+			        which happens on a background thread started at startup (request_detector).
+			pellet_tracker: Follows the detector scores of every frame and reports when the pellet is gone
+			        (pellet_tracker.py). Used in detector mode.
 	"""
 
-    def __init__(self, profile_list, arduino_client):
+    def __init__(self, profile_registry, arduino_client):
 
-        self.profile_list = profile_list
+        self.profile_registry = profile_registry
         self.arduino_client = arduino_client
         self.predict = True
-
-    def set_profile_list(self, profileList):
-
-        self.profile_list = profileList
-
-    # This function searches the SessionController's profile_list for a profile whose ID
-    # matches the supplied RFID. If a profile is found, it is returned. If no profile is found,
-    # -1 is returned. (Not very pythonic but I have C-like habits.)
+        # Connects to the camera service, starting it first if it isn't running yet
+        self.camera = CameraClient(launch_args=["--c", str(0), "--preroll", str(PREROLL_SECONDS),
+                                                "--s", FRAME_CHANNEL_NAME, "--m", CAPTURE_MODE,
+                                                "--w", VIDEO_WRITER_BACKEND])
+        print(self.camera.health())
+        # The service owns the shared memory, attach to it once it is up
+        self.frame_channel = SharedFrameChannel(FRAME_CHANNEL_NAME)
+        self.detector_worker = None
+        self.detector_loader = None
+        self.detector_ready = Event()
+        # set once loading the detector finished, whether it worked or not
+        self.detector_loaded = Event()
+        self.detector_error = None
+        self.pellet_tracker = PelletTracker(PELLET_TRACKER_ALPHA, gone_margin=PELLET_GONE_MARGIN,
+                                            back_margin=PELLET_BACK_MARGIN)
+
+    # Which presentation loop sessions run, see startSession.
+    def session_mode(self):
+        if use_detector:
+            return 'detector'
+        elif self.predict:
+            return 'cycle'
+        return 'idle'
+
+    # Start loading the pellet detector in the background, if it isn't loaded or loading already.
+    def request_detector(self):
+        if self.detector_loader is None:
+            self.detector_loader = Thread(target=self.load_detector_worker, args=())
+            self.detector_loader.daemon = True
+            self.detector_loader.start()
+
+    def load_detector_worker(self):
+        try:
+            detector = load_detector(DETECTOR_MODEL, DETECTOR_ROI)
+            self.pellet_tracker.set_threshold(detector.threshold)
+            print("Pellet tracker: gone above %.3f, back below %.3f (detector threshold %.3f)" %
+                  (self.pellet_tracker.gone_above, self.pellet_tracker.back_below, detector.threshold))
+            self.detector_worker = DetectorWorker(self.frame_channel, detector, batch_size=DETECTOR_BATCH_SIZE)
+            self.detector_worker.subscribe(self.pellet_tracker.update)
+            self.detector_worker.start()
+            self.detector_ready.set()
+        except Exception as e:
+            print("Pellet detector %s failed to load: %r" % (DETECTOR_MODEL, e))
+            self.detector_error = e
+        finally:
+            self.detector_loaded.set()
+
+    # Block until the pellet detector is loaded, starting the load if needed.
+    # Raises RuntimeError if it could not be loaded, rather than running sessions that can't score pellets.
+    def wait_for_detector(self):
+        self.request_detector()
+        if not self.detector_loaded.is_set():
+            print("Waiting for the pellet detector to load...")
+        self.detector_loaded.wait()
+        if self.detector_error is not None:
+            raise RuntimeError("Pellet detector %s failed to load: %r" % (DETECTOR_MODEL, self.detector_error))
+
+    # This function looks up the profile whose ID matches the supplied RFID. If a profile is found,
+    # it is returned. If no profile is found, -1 is returned. (Not very pythonic but I have C-like habits.)
     def searchForProfile(self, RFID):
 
-        for profile in self.profile_list:
-
-            if profile.ID == RFID:
-                return profile
-
-        return -1
+        profile = self.profile_registry.get(RFID)
+        if profile is None:
+            return -1
+        return profile
 
     def print_session_start_information(self, profile, startTime):
 
@@ -325,15 +402,25 @@ class SessionController(object):
         session_end_msg = profile.name + "'s session has completed\n-------------------------------------------\n"
         print(session_end_msg)
 
+    # Ask the camera service to start the session's video. If a main.py that crashed mid-session left its
+    # video open, that one is closed first (it stays on disk under its temp_ name) and the start is retried.
+    # Returns False if the service still won't record.
+    def start_video(self, path, preroll, show, mode):
+        reply = self.camera.start(path, preroll=preroll, show=show, mode=mode)
+        if reply['ok']:
+            return True
+        print("Closing the video left open by an earlier session")
+        self.camera.stop()
+        self.camera.wait_closed(VIDEO_CLOSE_TIMEOUT)
+        return self.camera.start(path, preroll=preroll, show=show, mode=mode)['ok']
+
     # This function starts an experiment session for the animal identified in the supplied <profile>.
     # The session remains active until a signal is received from the Arduino server indicating that
     # the IR beam breaker has been reconnected.
     #
-    # Each session forks a process that records video for the duration of the session.
-    # This function is also responsible for sending a terminate signal to that forked process.
-    # This signal is sent by creating a file called 'KILL' in the current working
-    # directory (Not good, but does the job. I was halfway through implementing IPC with sockets
-    # but didn't have time to finish).
+    # Each session asks the camera service to cut a video out of its stream for the duration of the session,
+    # starting PREROLL_SECONDS before <trigger_time> (the time.perf_counter() moment the RFID was read).
+    # This function is also responsible for telling the daemon when the session is over.
     #
     # This function is also responsible for telling the Arduino server how to position the stepper motors and
     # for periodically sending get pellet requests.
@@ -345,201 +432,192 @@ class SessionController(object):
     #
     # TODO: This function is pretty bloated and probably harder to read than it needs to be. Better separation
     # of concerns could be easily achieved by splitting it into a few smaller functions.
-    def startSession(self, profile):
+    def startSession(self, profile, trigger_time=None):
 
         startTime = time.time()
         profile.session_count += 1
         self.print_session_start_information(profile, startTime)
-        successful_count = 0
-        vidPath = profile.genVideoPath(startTime) + '.avi'
-        tempPath = os.path.join(os.path.dirname(vidPath), 'temp_'+ datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + '.avi')
+        video_extension = WRITER_EXTENSIONS[VIDEO_WRITER_BACKEND]
+        vidPath = profile.genVideoPath(startTime) + video_extension
+        tempPath = os.path.join(os.path.dirname(vidPath), 'temp_'+ datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + video_extension)
 
 
         print("saved as :"+vidPath)
+        # Every command sent to the Arduino, every message from it, each arm raise and each detector score
+        # goes into the session's event log
+        events = EventLog(profile.genEventLogPath(startTime), profile.session_count)
+        events.log(SESSION_START, profile.session_count, text=profile.ID)
+
+        def send(name, payload=b''):
+            events.log(SERIAL_TX, text=arduinoClient.COMMANDS[name] + payload)
+            return self.arduino_client.send(name, payload)
+
+        # Messages from the server (acknowledgements, TERM) arrive on the client's reader thread
+        def log_message(line, received_at):
+            events.log(SERIAL_RX, text=line, t_ns=int(received_at * 1e9))
+        self.arduino_client.subscribe(log_message)
+        # Frames published before this point belong to the previous session
+        session_frame_seq = self.frame_channel.sequence()
+        if trigger_time is None:
+            trigger_time = time.perf_counter()
+        show = False
         if "TEST" in profile.name:
             print("Its testing")
-            p = Popen(["python", "driver_for_a_better_camera.py", "--c", str(0), "--p", tempPath, "--t", "True"], stdin=PIPE, stdout=PIPE)
-        else:
-            p = Popen(["python", "driver_for_a_better_camera.py", "--c", str(0), "--p", tempPath, "--t", "False"], stdin=PIPE, stdout=PIPE)
+            show = True
+        retention_decision = RETENTION_POLICY.decide(profile)
+        print("Video: %s (%s)" % (retention_decision.mode, retention_decision.reason))
+        # the service counts the frames it dropped since it started, the session logs its own share
+        stats_at_start = self.camera.stats()
+        # the service measures the pre-roll on its own clock, so only the time since the trigger is sent over
+        preroll = PREROLL_SECONDS + time.perf_counter() - trigger_time
+        recording = self.start_video(tempPath, preroll, show, retention_decision.mode)
+        if not recording:
+            # the Arduino is already in its session, so the animal still gets its trials
+            print("Camera service won't record, running this session without video")
+        # Wait for the mouse to get into the tube. Only after the camera started, so the pre-roll the
+        # service has to hold back for is short.
+        time.sleep(1)
         # Tell server to move stepper to appropriate position for current profile
-        self.arduino_client.serialInterface.write(b'3')
-
         stepperMsg1 = scale_stepper_dist(profile.difficulty_dist_mm1)
         stepperMsg2 = scale_stepper_dist(profile.difficulty_dist_mm2)
         servoMsg = scale_stepper_dist(profile.difficulty_dist_mm3)
 
-        self.arduino_client.serialInterface.write(stepperMsg1.encode())
-        self.arduino_client.serialInterface.write(stepperMsg2.encode())
-        self.arduino_client.serialInterface.write(servoMsg.encode())
+        send('position', (stepperMsg1 + stepperMsg2 + servoMsg).encode())
 
         print(stepperMsg1, stepperMsg2, servoMsg)
 
-        # Main session loop. Runs until it receives TERM sig from server. Polls
-        # the camera queue for GETPEL messages and forwards to server if it receives one.
-
-        trial_count = 1
-        raise_moment = datetime.datetime.now()
         display_time_stamp_list = []
-        SEED_FLAG = False
 
-        def check_deetction_frame():
-            try:
-                os.rename("detection_frame.jpg", "detection_frame.jpg")
-                if os.path.getsize("detection_frame.jpg") > 10:
-                    return True
-                return False
-            except OSError as e:
-                return False
-
-        def detect(p):
+        def detect():
             '''
-            Wait for real code
-            :return:
+            Look at the detector worker's latest result for this session, without waiting for the detector.
+            A look without a usable result is logged as a DETECTION with a NaN score (unknown), not as
+            "pellet present".
+            :return: True if the detector thinks the pellet is gone
             '''
-            if os.path.exists("detection_frame.jpg"):
-                os.remove("detection_frame.jpg")
-            p.stdin.write(b"detect\n")
-            p.stdin.flush()
-
-            while not check_deetction_frame():
-                time.sleep(0.1)
-            img = cv2.imread("detection_frame.jpg")
-            time.sleep(1)
-
-            return D.predict_in_real_use(img)
-    
+            result = self.detector_worker.latest(newer_than=session_frame_seq)
+            if result is None:
+                print("No detector result for this session yet, skipping detection")
+                events.log(DETECTION, float('nan'))
+                return False
+            seq, timestamp, score = result
+            # capture times are on the camera service's time.time() based clock (see frame_channel.CaptureClock)
+            age = time.time() - timestamp
+            if age > DETECTOR_MAX_RESULT_AGE:
+                print("Detector result is %.1f s old, skipping detection" % age)
+                events.log(DETECTION, float('nan'))
+                return False
+            # stamped with the capture time of the frame, not the time the detector finished
+            events.log(DETECTION, score, t_ns=int(capture_to_perf_counter(timestamp) * 1e9))
+            return score > self.detector_worker.detector.threshold
 
-        # This is the main loop for the pellet detector. Basically there is a deque to keep track of
-        # the 1.5 second running average of the output from the pellet detector (3 detections). If the
-        # pellet detector doesnt see a pellet >= 2/3x it will set SEED_FLAG to True and send a message to
-        # the arduino to lower the arm. You can play around with the interval the pellet detector runs at and
-        # the threshold of the running average, and the duration of the running average.
+        # The presentations run on a state machine (see session_fsm.py) driven by timers and by the Arduino
+        # client's reader thread, which posts an event when the arm is up and when the server sends TERM.
         #
-        # SEED_FLAG == True ... the arm will lower and retrieve a new pellet
-        # SEED_FLAG == False ... the arm will stay idle until the detector cant see a pellet or pellet_wait_time_hard_limit
-        # is reached
-
-        # TODO: get this program to stop printing out the img.shape to console... no idea why its doing that so frequently
-
-        global use_detector
-        global pellet_wait_time_hard_limit
-        if use_detector:
-            # this is the time before the first presentation after the IR beam is broken. Changed 6 -> 4
-            time.sleep(4)
-            self.arduino_client.serialInterface.write(b'1')
-            self.arduino_client.serialInterface.flushOutput()
-            SEED_FLAG = False
-            detect_cnts = deque([0, 0, 0])
-
-            while True:
-                if self.predict:
-                    if (datetime.datetime.now() - raise_moment).seconds >= 0.5:
-                        detect_cnts.popleft()
-                        detect_cnts.append(detect(p))
-                        if sum(detect_cnts) < 2:
-                            time.sleep(0.5)
-                        else:
-                            SEED_FLAG = True
-                            print('pellet detector cant see a pellet... lowering arm')
-
-                    if (datetime.datetime.now() - raise_moment).seconds >= pellet_wait_time_hard_limit:
-                        print(f'{pellet_wait_time_hard_limit} seconds have passed, presenting new pellet')
-                        SEED_FLAG = True
-
-                    if SEED_FLAG:
-                        self.arduino_client.serialInterface.write(b'1')
-                        self.arduino_client.serialInterface.flushOutput()
-                        raise_moment = datetime.datetime.now()
-                        trial_count += 1
-                        display_time_stamp_list.append(raise_moment)
-                        SEED_FLAG = False
-                        detect_cnts[0], detect_cnts[1], detect_cnts[2] = 0,0,0
-                        time.sleep(0.5)
-
-                # Check if message has arrived from server, if it has, check if it is a TERM message.
-                if self.arduino_client.serialInterface.in_waiting > 0:
-                    serial_msg = self.arduino_client.serialInterface.readline().rstrip().decode()
-                    print("=========================================================")
-                    print("receive message from arduino: %s" % serial_msg)
-                    print("=========================================================")
-                    if serial_msg == "TERM":
-                        self.arduino_client.serialInterface.flush()
-                        self.arduino_client.serialInterface.flushInput()
-                        break
+        # cycle mode (default): present, look at the pellet once, count a success if it's gone, present again
+        # detector mode (use_detector): keep the pellet up until the pellet tracker, following the detector score
+        #                               of every frame, reports it gone, or pellet_wait_time_hard_limit is reached
+        # idle mode (self.predict False): present with the dominant hand every few seconds
+        mode = self.session_mode()
+        if mode != 'idle':
+            # loaded before the first RFID read (see main), this only raises if that load failed
+            self.wait_for_detector()
+        present_command = 'present_left'
+        if mode == 'idle':
+            present_command = {"LEFT": 'present_left', "RIGHT": 'present_right', "BOTH": 'present_both'}[profile.dominant_hand]
+
+        def present():
+            send(present_command)
+            events.log(ARM_RAISE, session.trial_count)
+            if mode != 'cycle':
+                display_time_stamp_list.append(datetime.datetime.now())
+
+        def pellet_taken():
+            display_time_stamp_list.append(datetime.datetime.now())
+
+        def pellet_gone(event):
+            gone_at = capture_to_perf_counter(event.time)
+            events.log(PELLET_GONE, event.confidence, t_ns=int(gone_at * 1e9))
+            session.post('gone', gone_at)
+
+        def state_changed(state, now):
+            events.log(STATE_CHANGE, SESSION_STATES.index(state), text=state, t_ns=int(now * 1e9))
+            if mode != 'detector':
+                return
+            # the tracker only follows a pellet while it's up
+            if state == DETECTING:
+                # the tracker compares this with the frames' capture times
+                self.pellet_tracker.arm(perf_counter_to_capture(now), pellet_gone)
+            else:
+                self.pellet_tracker.disarm()
+
+        session = SessionStateMachine(present, detect, mode, SESSION_TIMINGS, on_success=pellet_taken, on_state=state_changed)
+
+        def post_message(line, received_at):
+            if line == "TERM":
+                session.post('term', received_at)
+            elif line in ("ACK 1", "ACK 2", "ACK 4"):
+                session.post('presented', received_at)
+        self.arduino_client.subscribe(post_message)
+        # the mouse may already have left while the camera and steppers were being set up
+        if self.arduino_client.term.is_set():
+            session.post('term')
+
+        trial_count, successful_count = session.run()
+        self.arduino_client.unsubscribe(post_message)
+        print("=========================================================")
+        print("receive message from arduino: TERM (acted on after %.1f ms)" % (session.term_latency * 1000))
+        print("=========================================================")
+
+        self.arduino_client.unsubscribe(log_message)
+        # How long the server took to carry out each kind of command, over all sessions so far
+        for name, (count, mean, longest) in sorted(self.arduino_client.latency_summary().items()):
+            print("Arduino %s: %d acknowledged, mean %.3f s, max %.3f s" % (name, count, mean, longest))
+        if self.detector_ready.is_set():
+            print("Detector: %s" % self.detector_worker.stats())
+        if mode == 'detector':
+            print("Pellet tracker: %s" % self.pellet_tracker.summary())
+
+        if recording:
+            self.camera.stop()
+            # The service answers once the video (and its timestamp sidecar) is closed on disk
+            closed = self.camera.wait_closed(VIDEO_CLOSE_TIMEOUT)
         else:
-            # this is the time before the first presentation after the IR beam is broken. Changed 6 -> 4
-            time.sleep(4)
-            while True:
-                if self.predict:
-                    if (datetime.datetime.now() - raise_moment).seconds >= 4:
-                        # SEED_FLAG = detect(p)
-                        SEED_FLAG = False
-                    if not SEED_FLAG:
-                        self.arduino_client.serialInterface.write(b'1')
-                        self.arduino_client.serialInterface.flushOutput()
-                        trial_count += 1
-                        time.sleep(4)
-                        if detect(p):
-                            SEED_FLAG = False # do cycling all the time
-                            if "TEST" in profile.name:
-                                SEED_FLAG = False
-                            raise_moment = datetime.datetime.now()
-                            display_time_stamp_list.append(raise_moment)
-                            successful_count += 1
-                        else:
-                            SEED_FLAG = False
-                    print("Total trial: %d, successful trial: %d, Percentage; %.3f" % (trial_count, successful_count, float(successful_count) / float(trial_count)))
-                else:
-                    if (datetime.datetime.now() - raise_moment).seconds >= 5:
-                        if profile.dominant_hand == "LEFT":
-                            self.arduino_client.serialInterface.write(b'1')
-                        elif profile.dominant_hand == "RIGHT":
-                            self.arduino_client.serialInterface.write(b'2')
-                        elif profile.dominant_hand == "BOTH":
-                            self.arduino_client.serialInterface.write(b'4')
-                        raise_moment = datetime.datetime.now()
-                        trial_count += 1
-                        display_time_stamp_list.append(raise_moment)
-                        time.sleep(1)
-
-                # Check if message has arrived from server, if it has, check if it is a TERM message.
-                if self.arduino_client.serialInterface.in_waiting > 0:
-                    serial_msg = self.arduino_client.serialInterface.readline().rstrip().decode()
-                    print("=========================================================")
-                    print("receive message from arduino: %s" % serial_msg)
-                    print("=========================================================")
-                    if serial_msg == "TERM":
-                        self.arduino_client.serialInterface.flush()
-                        self.arduino_client.serialInterface.flushInput()
-                        break
-
-        p.stdin.write(b"stop\n")
-        p.stdin.flush()
-        for line in p.stdout.readlines():
-            print(line)
-        # Log session information.
-        while is_locked(tempPath):
-            time.sleep(1)
-
-        if trial_count == 0:
-            os.remove(tempPath)
-        else:
-            os.rename(tempPath, vidPath)
-
-        chance_of_save = 4
-        random_draw = random.randint(1, chance_of_save)
-        print('1/{} chance of saving. Video will only save if 1 is drawn'.format(chance_of_save))
-
-        if random_draw != 1:
-            print('{} drawn. video deleted'.format(random_draw))
-            os.remove(vidPath)
-        else:
-            print('1 drawn, video saved')
+            closed = {'ok': False}
+        camera_stats = self.camera.stats()
+        print(camera_stats)
+        if closed['ok']:
+            events.log(CAMERA_FRAMES, closed['frames'])
+        if camera_stats['ok'] and stats_at_start['ok']:
+            events.log(CAMERA_DROPPED, camera_stats['dropped'] - stats_at_start['dropped'])
+
+        if recording and not closed['ok']:
+            # Can't rename or delete a file that is still being written, leave it for the uploader to skip
+            print("Video was not closed after %d seconds, leaving it as %s" % (VIDEO_CLOSE_TIMEOUT, tempPath))
+        elif closed['ok']:
+            print("Video closed: %d frames, %.1f MB, %.1f seconds" % (closed['frames'], closed['bytes'] / 1e6, closed['duration']))
+
+            # The frame timestamp sidecar follows the video it belongs to
+            if trial_count == 0 or not RETENTION_POLICY.keep(profile, retention_decision, successful_count):
+                if os.path.exists(tempPath):
+                    os.remove(tempPath)
+                if os.path.exists(timestamp_path(tempPath)):
+                    os.remove(timestamp_path(tempPath))
+                if retention_decision.mode != retention.NONE:
+                    print("video deleted")
+            else:
+                os.rename(tempPath, vidPath)
+                if os.path.exists(timestamp_path(tempPath)):
+                    os.rename(timestamp_path(tempPath), timestamp_path(vidPath))
+                print("video saved")
 
         endTime = time.time()
+        events.log(SESSION_END, trial_count)
+        events.close()
         profile.insertSessionEntry(startTime, endTime, trial_count, successful_count)
         profile.insertDisplay(display_time_stamp_list)
-        profile.saveProfile()
+        # the session only changes the session count, everything else belongs to the GUI
+        profile.saveProfile(['session_count'])
         self.print_session_end_information(profile, endTime)
 
 def scale_stepper_dist(distance):
@@ -572,7 +650,9 @@ def sys_init():
     if use_scanner:
         ard_port, rfid_port = get_com_ports()
 
-    profile_list = loadAnimalProfiles(PROFILE_SAVE_DIRECTORY)
+    profile_registry = ProfileRegistry(PROFILE_STORE, animalProfileFromRecord)
+    profile_registry.refresh()
+    print([profile.name for profile in profile_registry.profiles()])
     if not use_scanner:
         if len(sys.argv) == 3:
             COM1 = str(sys.argv[1])
@@ -587,28 +667,15 @@ def sys_init():
     else:
         arduino_client = arduinoClient.client(ard_port, 9600)
         ser = serial.Serial(rfid_port, 9600)
+    # Reads and parses tags on its own thread from here on, see rfid_reader.py
+    rfid_reader = RFIDReader(ser).start()
 
     guiProcess = launch_gui()
-    session_controller = SessionController(profile_list, arduino_client)
-    return profile_list, arduino_client, session_controller, ser, guiProcess
-
-
-# This function listens to the open port of a serial object. It waits for <x02>
-# to indicate the start of an RFID, if then appends to a string until it detects <x03>, indicating the end
-# of the RFID.
-def listen_for_rfid(ser):
-    rfid = ''
-
-    while (ser.is_open):
-        byte = ser.read(1)
-
-        if (byte == b'\x02'):
-            rfid = ''
-        elif (byte == b'\x03'):
-            return rfid
-        else:
-            # print(byte)
-            rfid += byte.decode('utf-8')
+    session_controller = SessionController(profile_registry, arduino_client)
+    # load the detector while the rest starts up, sessions that need it wait for it (wait_for_detector)
+    if session_controller.session_mode() != 'idle':
+        session_controller.request_detector()
+    return profile_registry, arduino_client, session_controller, rfid_reader, guiProcess
 
 
 def main():
@@ -618,29 +685,31 @@ def main():
     loadAnimalProfileTrialLimits()
     # These are handles to all the main system components.
 
-    profile_list, arduino_client, session_controller, ser, guiProcess = sys_init()
+    profile_registry, arduino_client, session_controller, rfid_reader, guiProcess = sys_init()
+    # Sessions score pellets from their first trial on, so don't take a mouse before the detector is there
+    if session_controller.session_mode() != 'idle':
+        session_controller.wait_for_detector()
 
-    # Entry point of the system. This block waits for an RFID to enter the <SERIAL_INTERFACE_PATH> buffer.
-    # Once it receives an RFID, it parses it and searches for a profile with a matching RFID. If a profile
+    # Entry point of the system. This block waits for the RFID reader to report a tag.
+    # Once it receives an RFID, it searches for a profile with a matching RFID. If a profile
     # is found, it starts a session for that profile. If no profile is found, it goes back to listening for
     # an RFID.
 
     while True:
         # Block until RFID is received
         print("Waiting for RFID...")
-        RFID_code = listen_for_rfid(ser)[:12]
-        # Check RFID authorization
+        RFID_code, rfid_time = rfid_reader.get()
+        # Before checking the RFID, pick up any profile that was added or changed by the GUI or some other
+        # process since the last read. Only save files that changed on disk are parsed again.
+        profile_registry.refresh()
 
+        # Check RFID authorization
         profile = session_controller.searchForProfile(RFID_code)
 
         # RFID authorized
         if profile != -1:
 
-            # Before starting a session, reload the animal profiles. This is done incase a profile was
-            # changed by the GUI or some other process since the last load occured.
             resetAnimalProfileTrialsToday()
-            session_controller.set_profile_list(loadAnimalProfiles(PROFILE_SAVE_DIRECTORY))
-            profile = session_controller.searchForProfile(RFID_code)
 
             if(profile.mouseNumber == "1"):
                 if(mouse1TrialsToday >= mouse1TrialLimit):
@@ -678,19 +747,15 @@ def main():
                     mouse5TrialsToday += 1
 
             # Start a session on Arduino server side. <A> is the magic byte that tells the Arduino to start a session.
-            arduino_client.serialInterface.flushInput()
-            arduino_client.serialInterface.write(b'A')
+            arduino_client.term.clear()
+            arduino_client.send('start_session')
 
             # Start a session on Python client side.
-            # Wait for the mouse to get into the tube.
-            time.sleep(1)
-            session_controller.startSession(profile)
-            # After the session returns, flush the Arduino serial communication buffer.
-            arduino_client.serialInterface.flush()
-
-            # Load profileList after each session as well. Can't remember why I decided to reload profiles before AND after session, 
-            # but I don't see any downside and removing this might break something. 
-            session_controller.set_profile_list(loadAnimalProfiles(PROFILE_SAVE_DIRECTORY))
+            session_controller.startSession(profile, rfid_time)
+
+            # Make sure the session's profile save is on disk before the next RFID read looks at the save files
+            if not SESSION_JOURNAL.flush():
+                print("Some session data isn't on disk yet, the journal keeps trying to write it")
             loadAnimalProfileTrialLimits()
         # RFID NOT authorized
         else:
@@ -698,15 +763,14 @@ def main():
             # <Y> is the magic byte that tells the Arduino server that the RFID was rejected. Sending this rejection notice
             # is no longer necessary, it is a relic of when the RFID sensor was handled by the Arduino directly. However, removing it
             # would require modifying the Arduino server code and there's no need for that at present. 
-            arduino_client.serialInterface.write(b'Y')
+            arduino_client.send('reject')
             unrecognized_id_msg = RFID_code + " not recognized. Aborting session.\n\n"
             print(unrecognized_id_msg)
 
-        # Reset RFID serial buffers. This is necessary because while an animal is in a session, it's RFID chip will often 
-        # get read many times as it wiggles around under the RFID sensor. This buffer reset prevents those additional reads
-        # from being processed after the session ends. 
-        ser.reset_input_buffer()
-        ser.reset_output_buffer()
+        # While an animal is in a session, it's RFID chip will often get read many times as it wiggles around under
+        # the RFID sensor. The reader debounces most of those, drop the rest so they don't start another session.
+        # Reads of other tags stay queued.
+        rfid_reader.discard(RFID_code)
 
 # Python convention for launching main() function.
 if __name__ == "__main__":
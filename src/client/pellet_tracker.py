@@ -0,0 +1,136 @@
+"""
+    Decides when the pellet is gone from the stream of per-frame detector scores (detector_worker.py).
+
+    Single frame scores are noisy (the paw passing over the pellet, motion blur), so the tracker keeps an
+    exponentially weighted moving average of them:
+        level = alpha * score + (1 - alpha) * level
+    and uses two thresholds (hysteresis): the pellet is reported gone once the level rises to <gone_above>,
+    and is only considered back once the level falls to <back_below>. A level wavering around a single
+    threshold would otherwise report the same pellet gone over and over.
+
+    Both are placed around the detector's own threshold (detector_config.py, picked by
+    detector_calibration.py): <gone_above> <gone_margin> of the way from the threshold up to 1, <back_below>
+    <back_margin> of the way from the threshold down to 0. set_threshold moves them when a detector loads.
+
+    The tracker is armed when a pellet is up and only looks at frames captured after that. It reports a
+    PelletGone once per presentation, from the detector worker's thread. All its times are capture times,
+    on the camera service's time.time() based clock (see frame_channel.CaptureClock).
+"""
+import time
+from threading import Lock
+
+PRESENT = 'present'
+GONE = 'gone'
+
+
+class PelletGone(object):
+    '''
+    :param time: capture time of the frame that tipped the level over <gone_above>
+    :param confidence: the averaged score at that frame
+    :param since_armed: seconds from the pellet being up to that frame
+    :param lag: seconds from the first frame of the run of scores above the detector threshold that ended in the
+                report to that frame,
+                the delay added by the averaging
+    :param delay: seconds from that frame being captured to the report, the time the detector took
+    '''
+    def __init__(self, time, confidence, since_armed, lag, delay):
+        self.time = time
+        self.confidence = confidence
+        self.since_armed = since_armed
+        self.lag = lag
+        self.delay = delay
+
+
+class PelletTracker(object):
+    '''
+    :param alpha: weight of the newest score in the moving average, higher reacts faster and smooths less
+    :param threshold: the detector's threshold, a single score above it means the pellet looks gone
+    :param gone_margin: the pellet is gone once the average rises this fraction of the way from the threshold to 1
+    :param back_margin: a pellet reported gone counts as back once the average falls this fraction of the way from
+                        the threshold to 0
+    '''
+    def __init__(self, alpha=0.3, threshold=0.5, gone_margin=0.4, back_margin=0.2):
+        assert 0 < gone_margin < 1 and 0 < back_margin < 1, "margins have to be between 0 and 1"
+        self.alpha = alpha
+        self.gone_margin = gone_margin
+        self.back_margin = back_margin
+        self.lock = Lock()
+        self.set_threshold(threshold)
+        self.armed_at = None
+        self.on_gone = None
+        self.level = None
+        self.state = PRESENT
+        self.run_start = None
+        # every PelletGone reported
+        self.history = []
+
+    def set_threshold(self, threshold):
+        '''
+        Place the hysteresis thresholds around the detector's <threshold>.
+        '''
+        with self.lock:
+            self.threshold = threshold
+            self.gone_above = threshold + self.gone_margin * (1. - threshold)
+            self.back_below = threshold * (1. - self.back_margin)
+
+    def arm(self, since, on_gone=None):
+        '''
+        Start tracking a pellet that is up since <since> (capture clock, see frame_channel.perf_counter_to_capture).
+        :param on_gone: function(PelletGone) called when the pellet is gone
+        '''
+        with self.lock:
+            self.armed_at = since
+            self.on_gone = on_gone
+            self.level = None
+            self.state = PRESENT
+            self.run_start = None
+
+    def disarm(self):
+        with self.lock:
+            self.armed_at = None
+            self.on_gone = None
+
+    def update(self, seq, timestamp, score):
+        '''
+        Feed the detector score of the frame captured at <timestamp>. Thread safe.
+        :return: a PelletGone if this frame is the one the pellet is reported gone at, None otherwise
+        '''
+        with self.lock:
+            if self.armed_at is None or timestamp < self.armed_at:
+                return None
+            if self.level is None:
+                self.level = score
+            else:
+                self.level = self.alpha * score + (1 - self.alpha) * self.level
+            if score > self.threshold:
+                if self.run_start is None:
+                    self.run_start = timestamp
+            else:
+                self.run_start = None
+            if self.state == GONE:
+                if self.level <= self.back_below:
+                    self.state = PRESENT
+                return None
+            if self.level < self.gone_above:
+                return None
+            self.state = GONE
+            run_start = timestamp if self.run_start is None else self.run_start
+            event = PelletGone(timestamp, self.level, timestamp - self.armed_at, timestamp - run_start,
+                               time.time() - timestamp)
+            on_gone = self.on_gone
+            self.history.append(event)
+        if on_gone is not None:
+            on_gone(event)
+        return event
+
+    def summary(self):
+        '''
+        :return: dict with the number of pellets reported gone and the mean/max of their since_armed, lag and delay
+        '''
+        with self.lock:
+            history = list(self.history)
+        summary = {'gone': len(history)}
+        for name in ('since_armed', 'lag', 'delay'):
+            values = [getattr(event, name) for event in history]
+            summary[name] = (sum(values) / len(values), max(values)) if values else None
+        return summary
@@ -0,0 +1,44 @@
+"""
+    In-memory index of the AnimalProfiles, keyed by RFID.
+
+    main.py used to list the profile directory and parse every save file on each RFID read. The registry
+    keeps the profiles and, on refresh(), asks the ProfileStore (profile_store.py) which profiles changed
+    on disk since the last refresh; only those are built again.
+
+    A profile file that can't be read, or that changes while it is being read (the GUI saving it), is
+    skipped by the store and the previously loaded profile is kept until the next refresh.
+"""
+
+
+class ProfileRegistry(object):
+    '''
+    :param store: the ProfileStore the profiles live in
+    :param make_profile: function that builds a profile from a profile store record
+    '''
+    def __init__(self, store, make_profile):
+        self.store = store
+        self.make_profile = make_profile
+        # profile name -> profile
+        self.entries = {}
+        self.by_rfid = {}
+
+    def refresh(self):
+        '''
+        Bring the registry up to date with the profile store.
+        :return: True if any profile was (re)loaded or removed
+        '''
+        changes = self.store.poll()
+        for name, record in changes:
+            if record is None:
+                self.entries.pop(name, None)
+            else:
+                self.entries[name] = self.make_profile(record)
+        if changes:
+            self.by_rfid = dict((profile.ID, profile) for profile in self.entries.values())
+        return len(changes) > 0
+
+    def get(self, rfid):
+        return self.by_rfid.get(rfid)
+
+    def profiles(self):
+        return [self.entries[name] for name in sorted(self.entries)]
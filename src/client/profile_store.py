@@ -0,0 +1,262 @@
+"""
+    The one place AnimalProfiles are read from and written to disk. main.py, the GUI, genProfiles.py and
+    googleDriveManager.py all go through a ProfileStore instead of reading and writing the positional
+    <name>_save.txt files themselves.
+
+    Each profile is a JSON file, <AnimalProfiles>/<name>/<name>_profile.json, holding the fields in
+    PROFILE_SCHEMA plus a version number that goes up by one on every write. The first time a profile
+    that only has an old <name>_save.txt is written, it is converted and the old file is removed.
+
+    Writes:
+        update(name, changes) only changes the given fields. It takes the profile's lock file, reads the
+        current version from disk, applies the changes, and replaces the file through a temp file and
+        a rename. So the GUI changing a distance and a session bumping the session count can't undo
+        each other's work, and a reader never sees a half written file.
+
+    Change notification:
+        poll() stats the profile files and returns the profiles that changed since the last call (only those
+        are read again). subscribe(callback) has callback(name, record) called for every change poll() finds,
+        watch() runs poll() on a background thread.
+"""
+import json
+import os
+import time
+from threading import Thread
+
+# field, type, in the order of the old positional save files
+PROFILE_SCHEMA = [
+    ('ID', str),
+    ('name', str),
+    ('mouseNumber', str),
+    ('cageNumber', str),
+    ('difficulty_dist_mm1', int),
+    ('difficulty_dist_mm2', int),
+    ('difficulty_dist_mm3', int),
+    ('dominant_hand', str),
+    ('session_count', int),
+    ('animal_profile_directory', str),
+]
+PROFILE_FIELDS = dict(PROFILE_SCHEMA)
+
+
+class ProfileVersionError(Exception):
+    pass
+
+
+def validate(record, partial=False):
+    '''
+    Check <record> against PROFILE_SCHEMA and convert its fields to their types.
+    :param partial: only check the fields that are present (for updates)
+    :return: the converted record, raises ValueError if a field is missing, unknown or of the wrong type
+    '''
+    converted = {}
+    for field, value in record.items():
+        if field == 'version':
+            converted[field] = int(value)
+        elif field in PROFILE_FIELDS:
+            converted[field] = PROFILE_FIELDS[field](value)
+        else:
+            raise ValueError("Unknown profile field: %s" % field)
+    if not partial:
+        missing = [field for field, _ in PROFILE_SCHEMA if field not in converted]
+        if missing:
+            raise ValueError("Profile is missing %s" % ', '.join(missing))
+    return converted
+
+
+class ProfileLock(object):
+    '''
+    Lock file shared by every process that writes the profile. Held for a few milliseconds at a time,
+    a lock older than <stale_after> seconds was left behind by a crashed process and is taken over.
+    '''
+    def __init__(self, path, timeout=5.0, stale_after=10.0):
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                return self
+            except (IOError, OSError):
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.stale_after:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                if time.time() > deadline:
+                    raise IOError("Timed out waiting for profile lock %s" % self.path)
+                time.sleep(0.01)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class ProfileStore(object):
+    def __init__(self, profile_save_directory):
+        self.profile_save_directory = profile_save_directory
+        self.directory_mtime = None
+        self.names = []
+        # name -> ((mtime, size), record) for every profile poll() has seen
+        self.cache = {}
+        self.subscribers = []
+        # goes up by one for every change poll() finds, cheap to compare
+        self.generation = 0
+        self.watcher = None
+
+    def profile_path(self, name):
+        return os.path.join(self.profile_save_directory, name, name + "_profile.json")
+
+    def legacy_path(self, name):
+        return os.path.join(self.profile_save_directory, name, name + "_save.txt")
+
+    def lock(self, name):
+        return ProfileLock(os.path.join(self.profile_save_directory, name, name + "_profile.lock"))
+
+    def list_names(self):
+        return sorted(name for name in os.listdir(self.profile_save_directory)
+                      if os.path.isdir(os.path.join(self.profile_save_directory, name)))
+
+    def read_file(self, name):
+        '''
+        :return: ((mtime, size), record) read from disk, raises IOError or ValueError
+        '''
+        path = self.profile_path(name)
+        legacy = not os.path.exists(path)
+        if legacy:
+            path = self.legacy_path(name)
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        with open(path, 'r') as f:
+            if legacy:
+                lines = [line.strip() for line in f.readlines()]
+                if len(lines) < len(PROFILE_SCHEMA) - 1:
+                    raise ValueError("%s is incomplete" % path)
+                record = dict((field, value) for (field, _), value in zip(PROFILE_SCHEMA, lines))
+                record.setdefault('animal_profile_directory', os.path.join(self.profile_save_directory, name) + os.sep)
+                record['version'] = 0
+            else:
+                record = json.load(f)
+        # the file was replaced while we were reading it
+        st = os.stat(path)
+        if (st.st_mtime_ns, st.st_size) != key:
+            raise IOError("%s changed while it was being read" % path)
+        return key, validate(record)
+
+    def load(self, name):
+        return self.read_file(name)[1]
+
+    def load_all(self):
+        records = []
+        for name in self.list_names():
+            try:
+                records.append(self.load(name))
+            except (IOError, OSError, ValueError) as e:
+                print("Could not load AnimalProfile %s: %s" % (name, e))
+        return records
+
+    def write_file(self, name, record):
+        path = self.profile_path(name)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        if os.path.exists(self.legacy_path(name)):
+            os.remove(self.legacy_path(name))
+
+    def create(self, record):
+        '''
+        Write a new profile. Raises ProfileVersionError if the profile already exists.
+        '''
+        record = validate(dict(record, version=1))
+        name = record['name']
+        with self.lock(name):
+            if os.path.exists(self.profile_path(name)) or os.path.exists(self.legacy_path(name)):
+                raise ProfileVersionError("Profile %s already exists" % name)
+            self.write_file(name, record)
+        return record
+
+    def update(self, name, changes, expected_version=None):
+        '''
+        Change the fields in <changes> and bump the version.
+        :param expected_version: if given, only write if the profile on disk still has this version,
+                                 raises ProfileVersionError otherwise
+        :return: the new record
+        '''
+        changes = validate(changes, partial=True)
+        changes.pop('version', None)
+        with self.lock(name):
+            record = self.load(name)
+            if expected_version is not None and record['version'] != expected_version:
+                raise ProfileVersionError("Profile %s is at version %d, expected %d" %
+                                          (name, record['version'], expected_version))
+            if all(record.get(field) == value for field, value in changes.items()):
+                return record
+            record.update(changes)
+            record['version'] += 1
+            self.write_file(name, record)
+        return record
+
+    def version(self, name):
+        return self.load(name)['version']
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def poll(self):
+        '''
+        :return: list of (name, record) for every profile added or changed since the last call,
+                 record is None for a profile that was removed
+        '''
+        mtime = os.stat(self.profile_save_directory).st_mtime_ns
+        if mtime != self.directory_mtime:
+            self.directory_mtime = mtime
+            self.names = self.list_names()
+        changes = [(name, None) for name in self.cache if name not in self.names]
+        for name, _ in changes:
+            del self.cache[name]
+        for name in self.names:
+            path = self.profile_path(name)
+            if not os.path.exists(path):
+                path = self.legacy_path(name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                if self.cache.pop(name, None) is not None:
+                    changes.append((name, None))
+                continue
+            entry = self.cache.get(name)
+            if entry is not None and entry[0] == (st.st_mtime_ns, st.st_size):
+                continue
+            try:
+                key, record = self.read_file(name)
+            except (IOError, OSError, ValueError) as e:
+                # half written by an old style writer, or replaced under us, try again next poll
+                print("Could not load AnimalProfile %s: %s" % (name, e))
+                continue
+            self.cache[name] = (key, record)
+            changes.append((name, record))
+        for name, record in changes:
+            self.generation += 1
+            for callback in self.subscribers:
+                callback(name, record)
+        return changes
+
+    def watch(self, interval=1.0):
+        def run():
+            while True:
+                self.poll()
+                time.sleep(interval)
+        self.watcher = Thread(target=run, args=())
+        self.watcher.daemon = True
+        self.watcher.start()
+        return self
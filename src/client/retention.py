@@ -0,0 +1,86 @@
+"""
+    Decides at the start of a session what kind of video the session gets, instead of recording
+    everything and deleting most of it afterwards.
+
+    Modes:
+        full:  full resolution video, what we have always recorded
+        proxy: video at a fraction of the resolution, enough to check what happened in the session
+        none:  no video at all, the camera only feeds the pellet detector
+
+    Rules, checked in this order:
+        1. TEST tags are always recorded in full (keep_test_tags)
+        2. a mouse that already has its quota of full videos today gets the fallback mode (daily_quotas)
+        3. 1 in <sample_chance> sessions is recorded in full (random sampling)
+        4. keep_if_successful: record in full, but only keep the video if the mouse got at least one pellet
+        5. everything else gets the fallback mode (otherwise)
+"""
+import datetime
+import random
+
+FULL = 'full'
+PROXY = 'proxy'
+NONE = 'none'
+RETENTION_MODES = (FULL, PROXY, NONE)
+
+
+class RetentionDecision(object):
+    def __init__(self, mode, reason, keep_if_successful=False):
+        self.mode = mode
+        self.reason = reason
+        # the only rule that can't be settled at session start
+        self.keep_if_successful = keep_if_successful
+
+    def __repr__(self):
+        return "RetentionDecision(%s, %s)" % (self.mode, self.reason)
+
+
+class RetentionPolicy(object):
+    '''
+    :param sample_chance: record 1 in <sample_chance> sessions in full, 0 turns sampling off
+    :param daily_quotas: dict of animal name -> maximum number of full videos per day
+    :param keep_test_tags: always record TEST tag sessions in full
+    :param keep_if_successful: record sessions that weren't sampled in full and keep them only if a
+                               trial was successful
+    :param otherwise: mode for sessions no rule picked, NONE or PROXY
+    '''
+    def __init__(self, sample_chance=4, daily_quotas=None, keep_test_tags=True, keep_if_successful=False,
+                 otherwise=NONE):
+        assert otherwise in RETENTION_MODES, "Unknown retention mode: %s" % otherwise
+        self.sample_chance = sample_chance
+        self.daily_quotas = daily_quotas or {}
+        self.keep_test_tags = keep_test_tags
+        self.keep_if_successful = keep_if_successful
+        self.otherwise = otherwise
+        self.kept_today = {}
+        self.today = datetime.date.today()
+
+    def full_videos_today(self, name):
+        if datetime.date.today() != self.today:
+            self.today = datetime.date.today()
+            self.kept_today = {}
+        return self.kept_today.get(name, 0)
+
+    def decide(self, profile):
+        if self.keep_test_tags and "TEST" in profile.name:
+            return RetentionDecision(FULL, "test tag")
+        quota = self.daily_quotas.get(profile.name)
+        if quota is not None and self.full_videos_today(profile.name) >= quota:
+            return RetentionDecision(self.otherwise, "daily quota of %d videos reached" % quota)
+        if self.sample_chance > 0 and random.randint(1, self.sample_chance) == 1:
+            return RetentionDecision(FULL, "sampled (1/%d)" % self.sample_chance)
+        if self.keep_if_successful:
+            return RetentionDecision(FULL, "kept if successful", keep_if_successful=True)
+        return RetentionDecision(self.otherwise, "not sampled")
+
+    def keep(self, profile, decision, successful_count):
+        '''
+        Called once the session is over. Returns True if its video should be kept, and counts
+        kept full videos towards the animal's daily quota.
+        '''
+        if decision.mode == NONE:
+            return False
+        if decision.keep_if_successful and successful_count == 0:
+            return False
+        if decision.mode == FULL:
+            self.kept_today[profile.name] = self.full_videos_today(profile.name) + 1
+        return True
@@ -0,0 +1,143 @@
+"""
+    Background reader for the RFID sensor on the tube.
+
+    The sensor sends each tag read as a frame:
+        STX (0x02), 12 hex characters (10 characters of tag data, 2 of checksum), optionally CR/LF, ETX (0x03)
+    The checksum is the XOR of the five data bytes. A frame with a bad checksum is noise on the line
+    and is dropped.
+
+    The reader thread pulls whatever the port has buffered in one read() call, cuts it into frames and puts
+    (tag, time) on a queue, time being the time.perf_counter() moment the frame arrived (main.py turns it into
+    the camera's pre-roll, see CameraService.start). A mouse sitting under the sensor gets read over and over.
+    A read of the same tag within <debounce> seconds of its previous read is dropped, and every read restarts
+    that tag's debounce window. A queued read that get() drops as stale ends its tag's debounce window, so a
+    mouse that stayed under the sensor is reported again on its next read instead of never.
+"""
+import binascii
+import time
+from queue import Queue, Empty
+from threading import Thread
+
+STX = b'\x02'
+ETX = b'\x03'
+TAG_LENGTH = 12
+
+
+def parse_tag(payload):
+    '''
+    :param payload: bytes between STX and ETX
+    :return: the 12 character tag, or None if the frame is malformed or its checksum is wrong
+    '''
+    tag = payload.strip()[:TAG_LENGTH]
+    if len(tag) != TAG_LENGTH:
+        return None
+    try:
+        data = binascii.unhexlify(tag)
+    except (binascii.Error, ValueError):
+        return None
+    checksum = 0
+    for byte in data[:5]:
+        checksum ^= byte
+    if checksum != data[5]:
+        return None
+    return tag.decode('ascii')
+
+
+class RFIDReader(object):
+    '''
+    :param ser: open serial.Serial of the RFID sensor
+    :param debounce: seconds a tag has to be out of range before it is reported again
+    :param stale_after: get() skips reads older than this many seconds
+    '''
+    def __init__(self, ser, debounce=2.0, stale_after=5.0):
+        self.ser = ser
+        # short timeout so read() returns with whatever arrived instead of blocking for a full frame
+        self.ser.timeout = 0.05
+        self.debounce = debounce
+        self.stale_after = stale_after
+        self.queue = Queue()
+        self.buffer = b''
+        self.last_seen = {}
+        self.frames = 0
+        self.bad_frames = 0
+        self.debounced = 0
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        while not self.stopped and self.ser.is_open:
+            data = self.ser.read(max(1, self.ser.in_waiting))
+            if data:
+                self.feed(data, time.perf_counter())
+
+    def feed(self, data, timestamp):
+        self.buffer += data
+        while True:
+            start = self.buffer.find(STX)
+            if start < 0:
+                self.buffer = b''
+                return
+            end = self.buffer.find(ETX, start + 1)
+            if end < 0:
+                # keep the partial frame for the next read
+                self.buffer = self.buffer[start:]
+                return
+            payload = self.buffer[start + 1:end]
+            self.buffer = self.buffer[end + 1:]
+            # a new STX before the ETX means the start of this frame was lost
+            if STX in payload:
+                self.buffer = payload[payload.rfind(STX):] + ETX + self.buffer
+                continue
+            self.frames += 1
+            tag = parse_tag(payload)
+            if tag is None:
+                self.bad_frames += 1
+                continue
+            last = self.last_seen.get(tag)
+            self.last_seen[tag] = timestamp
+            if last is not None and timestamp - last < self.debounce:
+                self.debounced += 1
+                continue
+            self.queue.put((tag, timestamp))
+
+    def get(self, timeout=None):
+        '''
+        Block until a tag is read.
+        :return: (tag, time.perf_counter() time of the read), or (None, None) after <timeout> seconds
+        '''
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            remaining = None if deadline is None else max(0., deadline - time.perf_counter())
+            try:
+                tag, timestamp = self.queue.get(timeout=remaining)
+            except Empty:
+                return None, None
+            if time.perf_counter() - timestamp <= self.stale_after:
+                return tag, timestamp
+            # the mouse may still be under the sensor, its next read starts a session again
+            self.last_seen.pop(tag, None)
+
+    def discard(self, tag):
+        '''
+        Drop queued reads of <tag>, e.g. the reads of a mouse that was in the tube for the session that just ended.
+        Reads of other tags stay queued.
+        '''
+        kept = []
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except Empty:
+                break
+            if event[0] != tag:
+                kept.append(event)
+        for event in kept:
+            self.queue.put(event)
@@ -0,0 +1,158 @@
+"""
+    State machine that runs the pellet presentations of a session (SessionController.startSession in main.py).
+
+    States:
+        waiting      the mouse just entered the tube, first presentation after <initial_delay>
+        presenting   the arm is going up, until the Arduino acknowledges the move (or <present_timeout>)
+        detecting    the pellet is up, the detector looks at it
+        idle         the pellet is up, no detector, the next presentation comes after <idle_interval>
+        terminating  the Arduino reported the IR beam is reconnected (TERM), the session is over
+
+    Nothing sleeps: the machine waits on a single event queue with a timeout set to the current state's
+    deadline. Messages from the Arduino (post('presented'), post('term')) and from the pellet tracker
+    (post('gone')) end the wait right away, so a TERM is acted on within milliseconds whatever state the
+    session is in.
+
+    Modes (what happens once the pellet is up):
+        cycle     look once <detect_delay> seconds after the presentation, count a success if the pellet is
+                  gone, present again
+        detector  present again as soon as the pellet tracker (pellet_tracker.py) reports the pellet gone, or
+                  after <pellet_wait_limit> seconds
+        idle      present again every <idle_interval> seconds
+"""
+import time
+from queue import Queue, Empty
+
+WAITING = 'waiting'
+PRESENTING = 'presenting'
+DETECTING = 'detecting'
+IDLE = 'idle'
+TERMINATING = 'terminating'
+SESSION_STATES = (WAITING, PRESENTING, DETECTING, IDLE, TERMINATING)
+
+SESSION_MODES = ('cycle', 'detector', 'idle')
+
+
+class SessionTimings(object):
+    def __init__(self, initial_delay=4.0, present_timeout=5.0, detect_delay=4.0, pellet_wait_limit=25.0,
+                 idle_interval=5.0):
+        self.initial_delay = initial_delay
+        self.present_timeout = present_timeout
+        self.detect_delay = detect_delay
+        self.pellet_wait_limit = pellet_wait_limit
+        self.idle_interval = idle_interval
+
+
+class SessionStateMachine(object):
+    '''
+    :param present: function() that sends the arm up, called for every presentation
+    :param detect: function() returning True if the detector thinks the pellet is gone (cycle mode)
+    :param mode: one of SESSION_MODES
+    :param on_success: function() called when a pellet was taken (cycle mode)
+    :param on_state: function(state, time) called on every state change, time on the time.perf_counter() clock
+    '''
+    def __init__(self, present, detect, mode='cycle', timings=None, on_success=None, on_state=None):
+        assert mode in SESSION_MODES, "Unknown session mode: %s" % mode
+        self.present = present
+        self.detect = detect
+        self.mode = mode
+        self.timings = timings or SessionTimings()
+        self.on_success = on_success
+        self.on_state = on_state
+        self.events = Queue()
+        self.state = None
+        self.deadline = None
+        self.entered_at = None
+        self.raise_time = None
+        # starts at 1 like the session loop this replaces, so the session history keeps counting the same way
+        # (presentations + 1) and main.py keeps the video of a visit without presentations
+        self.trial_count = 1
+        self.successful_count = 0
+        self.term_time = None
+        # seconds between the TERM arriving and the session loop acting on it
+        self.term_latency = None
+
+    def post(self, name, received_at=None):
+        '''
+        Thread safe. <name> is 'presented' (the Arduino acknowledged the arm move), 'gone' (the pellet tracker
+        reports the pellet gone, <received_at> being the capture time of the frame it decided on) or 'term'.
+        <received_at> is on this process's time.perf_counter() clock, convert capture times with
+        frame_channel.capture_to_perf_counter.
+        '''
+        self.events.put((name, time.perf_counter() if received_at is None else received_at))
+
+    def enter(self, state, now, timeout=None):
+        self.state = state
+        self.entered_at = now
+        self.deadline = None if timeout is None else now + timeout
+        if self.on_state is not None:
+            self.on_state(state, now)
+
+    def run(self):
+        '''
+        Run the session until TERM. Returns (trial_count, successful_count).
+        '''
+        self.enter(WAITING, time.perf_counter(), self.timings.initial_delay)
+        while self.state != TERMINATING:
+            timeout = None
+            if self.deadline is not None:
+                timeout = max(0., self.deadline - time.perf_counter())
+            try:
+                name, received_at = self.events.get(timeout=timeout)
+            except Empty:
+                name, received_at = 'timeout', time.perf_counter()
+            self.handle(name, received_at)
+        return self.trial_count, self.successful_count
+
+    def handle(self, name, received_at):
+        now = time.perf_counter()
+        if name == 'term':
+            self.term_time = received_at
+            self.term_latency = now - received_at
+            self.enter(TERMINATING, now)
+        elif name == 'presented' and self.state == PRESENTING:
+            self.pellet_up(now)
+        elif name == 'gone' and self.state == DETECTING and self.mode == 'detector':
+            # a report about a pellet from before this presentation is stale
+            if received_at >= self.entered_at:
+                print('pellet detector cant see a pellet... lowering arm')
+                self.start_presentation(now)
+        elif name != 'timeout':
+            return
+        elif self.state == WAITING:
+            self.start_presentation(now)
+        elif self.state == PRESENTING:
+            # no acknowledgement from the Arduino, carry on as if the arm is up
+            self.pellet_up(now)
+        elif self.state == DETECTING:
+            self.look(now)
+        elif self.state == IDLE:
+            self.start_presentation(now)
+
+    def start_presentation(self, now):
+        self.trial_count += 1
+        self.raise_time = now
+        self.enter(PRESENTING, now, self.timings.present_timeout)
+        self.present()
+
+    def pellet_up(self, now):
+        if self.mode == 'cycle':
+            self.enter(DETECTING, now, max(0., self.raise_time + self.timings.detect_delay - now))
+        elif self.mode == 'detector':
+            self.enter(DETECTING, now, max(0., self.raise_time + self.timings.pellet_wait_limit - now))
+        else:
+            self.enter(IDLE, now, max(0., self.raise_time + self.timings.idle_interval - now))
+
+    def look(self, now):
+        if self.mode == 'cycle':
+            if self.detect():
+                self.successful_count += 1
+                if self.on_success is not None:
+                    self.on_success()
+            print("Total trial: %d, successful trial: %d, Percentage; %.3f" %
+                  (self.trial_count, self.successful_count, float(self.successful_count) / float(self.trial_count)))
+            self.start_presentation(time.perf_counter())
+            return
+        # detector mode, the tracker didn't report the pellet gone in time
+        print('%g seconds have passed, presenting new pellet' % self.timings.pellet_wait_limit)
+        self.start_presentation(now)
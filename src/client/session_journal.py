@@ -0,0 +1,252 @@
+"""
+    Buffered, crash-safe writer for the per-animal log files (session history, display history)
+    and the profile save files.
+
+    The session controller hands its writes to a SessionJournal and carries on; a background thread
+    collects them and writes each file once per flush interval. Three kinds of write:
+        append(path, lines)   add lines to the end of a log file
+        replace(path, lines)  replace the whole file, written to a temp file and renamed over the old one,
+                              so the file is either old or new, never half written
+        submit(function, *args)
+                              call function(*args) on the writer thread, after the appends and replaces
+                              queued with it (profile updates through the ProfileStore, see profile_store.py)
+
+    Appends are written one batch per file with a single write() call. If the PC dies in the middle
+    of one, the file can end in a partial line; the journal cuts that line off the next time it
+    appends to the file, so every line in a log is a complete entry.
+
+    fsync policy:
+        'always'   fsync after every batch (safest, slowest)
+        'interval' fsync at most once every <fsync_interval> seconds per file
+        'never'    leave it to the OS
+    Replaced files are always fsynced before the rename, otherwise the rename could land on disk
+    before the data does.
+
+    A write that fails with an IOError/OSError (a file held open by another program, a full disk) stays
+    queued and is tried again every flush interval, ahead of anything queued for the same file after it.
+    Calls that fail with any other exception are reported and dropped, trying them again won't help.
+    flush() and close() return False while anything they waited for is still failing or was dropped.
+"""
+import os
+import time
+from collections import OrderedDict
+from threading import Condition, Thread
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+def _repair_tail(path):
+    # Cut off a partial last line left behind by a write that never finished
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        block = min(size, 4096)
+        while True:
+            f.seek(size - block)
+            data = f.read(block)
+            end = data.rfind(b'\n')
+            if end >= 0:
+                f.truncate(size - block + end + 1)
+                return
+            if block == size:
+                f.truncate(0)
+                return
+            block = min(size, block * 2)
+
+
+def _atomic_replace(path, data):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class SessionJournal(object):
+    '''
+    :param flush_interval: seconds the writer thread waits to collect writes before flushing them
+    :param fsync: one of FSYNC_POLICIES
+    :param fsync_interval: seconds between fsyncs of the same file with the 'interval' policy
+    '''
+    def __init__(self, flush_interval=1.0, fsync='interval', fsync_interval=10.0):
+        assert fsync in FSYNC_POLICIES, "Unknown fsync policy: %s" % fsync
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        # path -> list of pending lines, or the full contents for a replace
+        self.pending_appends = OrderedDict()
+        self.pending_replaces = OrderedDict()
+        self.pending_calls = []
+        self.last_fsync = {}
+        self.repaired = set()
+        self.submitted = 0
+        self.written = 0
+        # writes waiting to be tried again, and calls given up on
+        self.retrying = 0
+        self.dropped = 0
+        self.failing = set()
+        self.condition = Condition()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def append(self, path, lines):
+        '''
+        Queue <lines> (strings without the trailing newline) to be appended to <path>.
+        '''
+        with self.condition:
+            self.pending_appends.setdefault(path, []).extend(lines)
+            self.submitted += 1
+            self.condition.notify_all()
+
+    def replace(self, path, lines):
+        '''
+        Queue a rewrite of <path> with <lines>. Only the latest queued contents of a file get written.
+        '''
+        with self.condition:
+            self.pending_replaces[path] = ''.join(line + '\n' for line in lines)
+            self.submitted += 1
+            self.condition.notify_all()
+
+    def submit(self, function, *args):
+        '''
+        Queue a call to function(*args) on the writer thread.
+        '''
+        with self.condition:
+            self.pending_calls.append((function, args))
+            self.submitted += 1
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        '''
+        Block until everything queued before the call has been tried (or <timeout> seconds pass).
+        :return: True if everything was written, False if the time ran out or a write failed (failed writes
+                 stay queued and are tried again)
+        '''
+        with self.condition:
+            target = self.submitted
+            dropped = self.dropped
+            self.condition.notify_all()
+            running = self.thread is not None and self.thread.is_alive()
+            if running:
+                if not self.condition.wait_for(lambda: self.written >= target, timeout):
+                    return False
+                return self.retrying == 0 and self.dropped == dropped
+        # no writer thread (not started, or already closed), write from the calling thread
+        self.write_pending()
+        return self.retrying == 0 and self.dropped == dropped
+
+    def close(self, timeout=10.0):
+        '''
+        Write everything still queued and stop the writer thread.
+        :return: True if everything was written, writes still failing at this point are lost
+        '''
+        written = self.flush(timeout)
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        if self.retrying:
+            print("Session journal: %d writes could not be saved: %s" % (self.retrying, ', '.join(sorted(self.failing))))
+        return written
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or self.written < self.submitted or self.retrying)
+                if self.stopped:
+                    return
+            # give the session a moment to queue up more writes
+            time.sleep(self.flush_interval)
+            self.write_pending()
+
+    def write_pending(self):
+        # take everything queued so far, then write it without holding the lock so
+        # the session controller never waits on the disk
+        with self.condition:
+            appends, self.pending_appends = self.pending_appends, OrderedDict()
+            replaces, self.pending_replaces = self.pending_replaces, OrderedDict()
+            calls, self.pending_calls = self.pending_calls, []
+            target = self.submitted
+        failed_appends = OrderedDict()
+        failed_replaces = OrderedDict()
+        failed_calls = []
+        dropped = 0
+        for path, lines in appends.items():
+            try:
+                self.write_append(path, lines)
+                self.succeeded(path)
+            except (IOError, OSError) as e:
+                self.failed(path, "could not append to %s: %s" % (path, e))
+                # the failed write may have left a partial line behind
+                self.repaired.discard(path)
+                failed_appends[path] = lines
+        for path, data in replaces.items():
+            try:
+                _atomic_replace(path, data.encode())
+                self.succeeded(path)
+            except (IOError, OSError) as e:
+                self.failed(path, "could not write %s: %s" % (path, e))
+                failed_replaces[path] = data
+        for function, args in calls:
+            name = getattr(function, '__name__', str(function))
+            try:
+                function(*args)
+                self.succeeded(name)
+            except (IOError, OSError) as e:
+                self.failed(name, "%s failed: %r" % (name, e))
+                failed_calls.append((function, args))
+            except Exception as e:
+                print("Session journal: %s failed, giving up on it: %r" % (name, e))
+                dropped += 1
+        with self.condition:
+            # failed writes go back in front of anything queued for the same file since
+            for path, lines in failed_appends.items():
+                self.pending_appends[path] = lines + self.pending_appends.get(path, [])
+            for path, data in failed_replaces.items():
+                # a newer replace of the file supersedes the failed one
+                self.pending_replaces.setdefault(path, data)
+            self.pending_calls[:0] = failed_calls
+            self.retrying = len(failed_appends) + len(failed_replaces) + len(failed_calls)
+            self.dropped += dropped
+            self.written = target
+            self.condition.notify_all()
+
+    def failed(self, name, message):
+        # report a failing file or call once, not on every retry
+        if name not in self.failing:
+            print("Session journal: %s, will keep trying" % message)
+            self.failing.add(name)
+
+    def succeeded(self, name):
+        if name in self.failing:
+            print("Session journal: %s written" % name)
+            self.failing.discard(name)
+
+    def write_append(self, path, lines):
+        if path not in self.repaired:
+            _repair_tail(path)
+            self.repaired.add(path)
+        data = ''.join(line + '\n' for line in lines).encode()
+        with open(path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            now = time.time()
+            if self.fsync == 'always' or \
+                    (self.fsync == 'interval' and now - self.last_fsync.get(path, 0) >= self.fsync_interval):
+                os.fsync(f.fileno())
+                self.last_fsync[path] = now
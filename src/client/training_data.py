@@ -0,0 +1,75 @@
+"""
+    Streams the labelled frames to Detector.train_on_folder a batch at a time.
+
+    prepare_for_training (data_utils.py) reads every frame into one array before training starts, so the
+    dataset has to fit in RAM. Here the frames stay in the memory mapped dataset cache (dataset_cache.py).
+    Each batch is read from the cache, augmented and scaled when keras asks for it; with workers > 1 in
+    fit_generator several batches are prepared at once on threads while the model trains on the previous one.
+    The training order is shuffled again at the end of every epoch.
+"""
+import math
+
+import keras
+import numpy as np
+
+from dataset_cache import open_dataset
+from detector_input import INPUT_SIZE
+
+
+class LabelledImageSequence(keras.utils.Sequence):
+    '''
+    :param frames: uint8 (n, 224, 224, 3) array of all frames, usually the dataset cache's memmap
+    :param labels: label of every frame, 1 if the pellet is gone
+    :param indices: the frames this sequence goes through
+    :param augment: keras ImageDataGenerator whose random_transform is applied to every image, None for no
+                    augmentation
+    :param shuffle: shuffle the order of the images at the end of every epoch
+    '''
+    def __init__(self, frames, labels, indices, batch_size=32, augment=None, shuffle=True, seed=None):
+        self.frames = frames
+        self.labels = np.asarray(labels, dtype=np.float32)
+        self.batch_size = batch_size
+        self.augment = augment
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(seed)
+        self.order = np.array(indices)
+        if shuffle:
+            self.random.shuffle(self.order)
+
+    def __len__(self):
+        return int(math.ceil(len(self.order) / float(self.batch_size)))
+
+    def __getitem__(self, index):
+        # called from several worker threads at once, so every batch gets its own arrays
+        # sorted so the frames are read from the cache file in order
+        indices = np.sort(self.order[index * self.batch_size:(index + 1) * self.batch_size])
+        images = self.frames[indices]
+        x = np.empty((len(indices), INPUT_SIZE, INPUT_SIZE, 3), dtype=np.float32)
+        for i, image in enumerate(images):
+            if self.augment is not None:
+                image = self.augment.random_transform(image.astype(np.float32))
+            np.multiply(image, np.float32(1. / 255.), out=x[i], casting='unsafe')
+        return x, self.labels[indices]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.random.shuffle(self.order)
+
+
+def labelled_sequences(data_folder, batch_size=32, split=0.1, augment=None, seed=2020):
+    '''
+    Split the labelled frames in <data_folder> (0 and 1 folders, see data_utils.generate_dataset) at random into
+    a training and a validation sequence. Only the training sequence is augmented and reshuffled. New labelled
+    frames are packed into the dataset cache first.
+    :param split: fraction of the frames kept for validation
+    :return: (training sequence, validation sequence)
+    '''
+    frames, labels, _ = open_dataset(data_folder)
+    order = np.random.RandomState(seed).permutation(len(labels))
+    validation_count = int(len(labels) * split)
+    validation, training = np.sort(order[:validation_count]), order[validation_count:]
+    print("Training on %d frames, validating on %d" % (len(training), len(validation)))
+    training_sequence = LabelledImageSequence(frames, labels, training, batch_size, augment=augment, shuffle=True,
+                                              seed=seed)
+    validation_sequence = LabelledImageSequence(frames, labels, validation, batch_size, shuffle=False)
+    return training_sequence, validation_sequence
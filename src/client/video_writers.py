@@ -0,0 +1,176 @@
+"""
+    Video writer backends for the recorder. Every backend takes grayscale uint8 frames and has the
+    same three methods: write(frame), release() and bytes_written().
+
+    1. opencv: cv2.VideoWriter, MJPG (or any other fourcc) in an AVI. What we have always used.
+    2. raw:    uncompressed frame dump in a .npy file, np.load(path, mmap_mode='r') opens it without
+               reading it. Cheapest on CPU, most expensive on disk.
+    3. ffmpeg: frames piped into an ffmpeg process (libx264 by default). Needs ffmpeg on the PATH.
+
+    Run this script to benchmark the backends on the current machine:
+        python video_writers.py --frames 1200
+"""
+import argparse
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+
+def npy_header(dtype, shape, header_len=128):
+    '''
+    Fixed size .npy (version 1.0) header, so it can be written before the data and patched in place
+    once the final shape is known.
+    '''
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    prefix = b'\x93NUMPY\x01\x00' + struct.pack('<H', header_len - 10)
+    return prefix + header.ljust(header_len - 11).encode('latin1') + b'\n'
+
+
+class OpenCVWriter:
+    def __init__(self, path, fps, size, fourcc='MJPG'):
+        self.path = path
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size, False)
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+    def bytes_written(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+
+class RawFrameWriter:
+    '''
+    Appends frames to a .npy file of shape (n_frames, height, width). The frame count in the
+    header is filled in on release().
+    '''
+    def __init__(self, path, fps, size):
+        self.path = path
+        self.shape = (size[1], size[0])
+        self.count = 0
+        self.file = open(path, 'wb')
+        self.file.write(npy_header(np.uint8, (0,) + self.shape))
+
+    def write(self, frame):
+        self.file.write(np.ascontiguousarray(frame).data)
+        self.count += 1
+
+    def release(self):
+        self.file.seek(0)
+        self.file.write(npy_header(np.uint8, (self.count,) + self.shape))
+        self.file.close()
+
+    def bytes_written(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+
+class FFmpegPipeWriter:
+    def __init__(self, path, fps, size, codec='libx264', preset='ultrafast', crf=23, ffmpeg='ffmpeg'):
+        self.path = path
+        command = [ffmpeg, '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', 'gray', '-s', '%dx%d' % size, '-r', str(fps), '-i', '-',
+                   '-c:v', codec, '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p', path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    def bytes_written(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+
+WRITER_BACKENDS = {
+    'opencv': OpenCVWriter,
+    'raw': RawFrameWriter,
+    'ffmpeg': FFmpegPipeWriter,
+}
+
+# file extension each backend's output should be saved with
+WRITER_EXTENSIONS = {
+    'opencv': '.avi',
+    'raw': '.npy',
+    'ffmpeg': '.avi',
+}
+
+
+def make_writer(backend, path, fps=120.0, size=(1280, 720), **kwargs):
+    assert backend in WRITER_BACKENDS, "Unknown video writer backend: %s" % backend
+    return WRITER_BACKENDS[backend](path, fps, size, **kwargs)
+
+
+def synthetic_frames(n=32, size=(1280, 720), seed=0):
+    '''
+    A short loop of 720p grayscale frames that looks a bit like the cage: a static textured
+    background with a bright blob moving across it, plus sensor noise.
+    '''
+    rng = np.random.RandomState(seed)
+    w, h = size
+    background = cv2.GaussianBlur(rng.randint(0, 255, (h, w), dtype=np.uint8), (15, 15), 0)
+    frames = []
+    for i in range(n):
+        frame = background.copy()
+        cv2.circle(frame, (int(w * i / n), h // 2), 40, 255, -1)
+        noise = rng.randint(0, 8, (h, w), dtype=np.uint8)
+        frames.append(cv2.add(frame, noise))
+    return frames
+
+
+def benchmark(backends, n_frames=1200, fps=120.0, size=(1280, 720), output_dir=None):
+    '''
+    Write <n_frames> synthetic frames through each backend as fast as it will take them.
+    :return: dict of backend -> (sustained fps, bytes per second of video, bytes per frame)
+    '''
+    frames = synthetic_frames(size=size)
+    cleanup = output_dir is None
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix='writer_benchmark_')
+    results = {}
+    for backend in backends:
+        path = os.path.join(output_dir, 'benchmark_' + backend + WRITER_EXTENSIONS[backend])
+        writer = make_writer(backend, path, fps, size)
+        start = time.perf_counter()
+        for i in range(n_frames):
+            writer.write(frames[i % len(frames)])
+        writer.release()
+        elapsed = time.perf_counter() - start
+        n_bytes = writer.bytes_written()
+        # bytes per second of recorded video is what fills the disk between uploads
+        results[backend] = (n_frames / elapsed, n_bytes * fps / n_frames, n_bytes / float(n_frames))
+        os.remove(path)
+    if cleanup:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=1200, help='number of frames written per backend')
+    parser.add_argument('--fps', type=float, default=120.0, help='nominal recording frame rate')
+    parser.add_argument('--backends', nargs='+', default=sorted(WRITER_BACKENDS), help='backends to benchmark')
+    args = parser.parse_args()
+
+    backends = args.backends
+    if 'ffmpeg' in backends and shutil.which('ffmpeg') is None:
+        print("ffmpeg not found on the PATH, skipping the ffmpeg backend")
+        backends = [b for b in backends if b != 'ffmpeg']
+
+    results = benchmark(backends, args.frames, args.fps)
+    print("%-8s %14s %16s %14s" % ('backend', 'sustained fps', 'MB per second', 'KB per frame'))
+    for backend in backends:
+        sustained_fps, bytes_per_second, bytes_per_frame = results[backend]
+        print("%-8s %14.1f %16.1f %14.1f" % (backend, sustained_fps, bytes_per_second / 1e6, bytes_per_frame / 1e3))
+        if sustained_fps < args.fps:
+            print("         -> cannot keep up with %.0f fps on this machine" % args.fps)